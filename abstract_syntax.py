@@ -1,10 +1,13 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
+from contextlib import contextmanager, nullcontext
 from lark.tree import Meta
 from typing import Tuple, List, Optional, Set, Self
-from error import error, warning, static_error, match_failed, MatchFailed
+from error import error, warning, static_error, match_failed, lazy_match_failed, MatchFailed
 from flags import *
 from pathlib import Path
-from edit_distance import edit_distance
+from edit_distance import close_matches
+from profiler import profile_phase, work, traced
+from counters import count
 from math import ceil
 import os
 
@@ -38,6 +41,13 @@ def set_current_module(name):
 @dataclass
 class AST:
   location: Meta
+  # Names of the fields that hold sub-terms, for the generic traversals
+  # below. A field may hold a single node or a list of nodes.
+  # None means the node does not support generic traversal.
+  child_slots = None
+  # Attributes set after construction that describe the children, and
+  # so are not carried over when the node is rebuilt with new ones.
+  derived_attrs = ()
 
   def copy(self) -> Self:
     error(self.location, 'copy not implemented for \n\t' + repr(self))
@@ -102,11 +112,113 @@ class Statement(AST):
   def pretty_print(self, indent: int) -> str:
       return str(self)
 
+############ Generic Traversal ###########
+
+def children(node):
+  slots = type(node).child_slots
+  if slots is None:
+    error(node.location, 'no child slots declared for ' + str(node))
+  ret = []
+  for slot in slots:
+    child = getattr(node, slot)
+    if isinstance(child, (list, tuple)):
+      ret += child
+    else:
+      ret.append(child)
+  return ret
+
+field_names_cache = {}
+
+def field_names(cls):
+  if cls not in field_names_cache:
+    field_names_cache[cls] = [f.name for f in fields(cls)]
+  return field_names_cache[cls]
+
+def rebuild(node, changes):
+  """A new node of the same class, with the fields in `changes` replaced.
+  The attributes set after construction, such as type_args or the env of
+  a Lambda, are kept."""
+  new = type(node)(*[changes[n] if n in changes else getattr(node, n)
+                     for n in field_names(type(node))])
+  for (name, value) in node.__dict__.items():
+    if name not in new.__dict__ and name not in type(node).derived_attrs:
+      setattr(new, name, value)
+  return new
+
+def with_children(node, new_children):
+  """Rebuild `node` from a list of children in the order of `children`.
+  The node itself is returned when every child is unchanged."""
+  changes = {}
+  i = 0
+  for slot in type(node).child_slots:
+    old = getattr(node, slot)
+    if isinstance(old, (list, tuple)):
+      # The lalr parser builds tuples where the other parser builds lists.
+      new = type(old)(new_children[i : i + len(old)])
+      i += len(old)
+      if any(a is not b for (a, b) in zip(old, new)):
+        changes[slot] = new
+    else:
+      new = new_children[i]
+      i += 1
+      if new is not old:
+        changes[slot] = new
+  if len(changes) == 0:
+    return node
+  return rebuild(node, changes)
+
+def map_children(node, f):
+  return with_children(node, [f(child) for child in children(node)])
+
+def replace_child(node, i, new_child):
+  new_children = children(node)
+  new_children[i] = new_child
+  return with_children(node, new_children)
+
 ################ Miscellaneous Functions #####################
 
 def copy_dict(d):
   return {k: v for k, v in d.items()}
 
+_missing = object()
+
+class ScopedDict(dict):
+  """The environment used by uniquify. Instead of copying the whole
+  dictionary at every binder, push() opens a scope that records the
+  previous value of each key that is set, and pop() restores them."""
+
+  def __init__(self, *args):
+    super().__init__(*args)
+    self.undo_log = []
+
+  def __setitem__(self, key, value):
+    if self.undo_log:
+      frame = self.undo_log[-1]
+      if key not in frame:
+        frame[key] = self.get(key, _missing)
+    super().__setitem__(key, value)
+
+  def push(self):
+    self.undo_log.append({})
+
+  def pop(self):
+    for (key, old) in self.undo_log.pop().items():
+      if old is _missing:
+        super().__delitem__(key)
+      else:
+        super().__setitem__(key, old)
+
+@contextmanager
+def new_scope(env):
+  if isinstance(env, ScopedDict):
+    env.push()
+    try:
+      yield env
+    finally:
+      env.pop()
+  else:
+    yield ScopedDict(env)
+
 
 def maybe_str(o: Optional[str], default='') -> str:
   return str(o) if o is not None else default
@@ -160,21 +272,30 @@ def type_match(loc, tyvars, param_ty, arg_ty, matching):
       type_match(loc, tyvars, rt1, rt2, matching)
     case (TypeInst(l1, n1, args1), TypeInst(l2, n2, args2)):
       if n1 != n2 or len(args1) != len(args2):
-        match_failed(loc, str(arg_ty) + " does not match " + str(param_ty))
+        lazy_match_failed(loc, lambda: str(arg_ty) + " does not match " + str(param_ty))
       for (arg1, arg2) in zip(args1, args2):
         type_match(loc, tyvars, arg1, arg2, matching)
     # How to handle GenericUnknownInst?
     case (TypeInst(l1, n1, args1), GenericUnknownInst(l2, n2)):
       if n1 != n2:
-        match_failed(loc, str(arg_ty) + " does not match " + str(param_ty))
+        lazy_match_failed(loc, lambda: str(arg_ty) + " does not match " + str(param_ty))
     case _:
       if param_ty != arg_ty:
-        match_failed(loc, str(arg_ty) + " does not match " + str(param_ty))
+        lazy_match_failed(loc, lambda: str(arg_ty) + " does not match " + str(param_ty))
 
 
 def is_associative(loc, opname, typ, env):
+  binding = env.get_assoc_binding(opname)
+  if binding is None:
+    return False
+  key = term_key(typ)
+  if key not in binding.cache:
+    binding.cache[key] = match_assoc_types(loc, binding.types, typ)
+  return binding.cache[key]
+
+def match_assoc_types(loc, types, typ):
   #print('is_associative? ' + str(opname) + ' for ' + str(typ))
-  for (typarams, ty) in env.get_assoc_types(opname):
+  for (typarams, ty) in types:
     type_params = type_names(loc, typarams)
     matching = {}
     try:
@@ -213,15 +334,40 @@ def rator_name(rator):
 
 
 def flatten_assoc(op_name, trm):
+  result = []
+  flatten_assoc_into(op_name, trm, result)
+  return result
+
+
+def flatten_assoc_list(op_name, args):
+  result = []
+  for arg in args:
+    flatten_assoc_into(op_name, arg, result)
+  return result
+
+
+def flatten_assoc_into(op_name, trm, result):
   match trm:
     case Call(loc2, tyof, rator, args) if rator_name(rator) == op_name:
-      return sum([flatten_assoc(op_name, arg) for arg in args], [])
+      if is_flat_assoc(trm):
+        result.extend(args)
+      else:
+        for arg in args:
+          flatten_assoc_into(op_name, arg, result)
     case _:
-      return [trm]
+      result.append(trm)
 
 
-def flatten_assoc_list(op_name, args):
-  return sum([flatten_assoc(op_name, arg) for arg in args], [])
+def mk_flat_assoc(loc, tyof, rator, flat_args):
+  """Make a call to an associative operator whose arguments have
+  already been flattened, so that flattening it again is just a copy."""
+  call = Call(loc, tyof, rator, flat_args)
+  call.flattened = True
+  return call
+
+
+def is_flat_assoc(call):
+  return getattr(call, 'flattened', False)
 
 
 @dataclass(kw_only=True)
@@ -385,14 +531,14 @@ class FunctionType(Type):
                           self.return_type.substitute(new_sub))
     
   def uniquify(self, env):
-    body_env = {x:y for (x,y) in env.items()}
-    new_type_params = [generate_name(t) for t in self.type_params]
-    for (old,new) in zip(self.type_params, new_type_params):
-      overwrite(body_env, old, new, self.location)        
-    self.type_params = new_type_params
-    for p in self.param_types:
-      p.uniquify(body_env)
-    self.return_type.uniquify(body_env)
+    with new_scope(env) as body_env:
+      new_type_params = [generate_name(t) for t in self.type_params]
+      for (old,new) in zip(self.type_params, new_type_params):
+        overwrite(body_env, old, new, self.location)        
+      self.type_params = new_type_params
+      for p in self.param_types:
+        p.uniquify(body_env)
+      self.return_type.uniquify(body_env)
     
   def reduce(self, env):
     return FunctionType(self.location, self.type_params,
@@ -590,6 +736,7 @@ class PatternTerm(Pattern):
 class Generic(Term):
   type_params: List[str]
   body: Term
+  child_slots = ('body',)
 
   def copy(self):
     return Generic(self.location, self.typeof,
@@ -624,12 +771,12 @@ class Generic(Term):
       return Generic(self.location, self.typeof, self.type_params, self.body.substitute(new_sub))
 
   def uniquify(self, env):
-    body_env = {x:y for (x,y) in env.items()}
-    new_type_params = [generate_name(x) for x in self.type_params]
-    for (old,new) in zip(self.type_params, new_type_params):
-      overwrite(body_env, old, new, self.location)
-    self.type_params = new_type_params
-    self.body.uniquify(body_env)
+    with new_scope(env) as body_env:
+      new_type_params = [generate_name(x) for x in self.type_params]
+      for (old,new) in zip(self.type_params, new_type_params):
+        overwrite(body_env, old, new, self.location)
+      self.type_params = new_type_params
+      self.body.uniquify(body_env)
     
   
 @dataclass
@@ -637,6 +784,7 @@ class Conditional(Term):
   cond: Term
   thn: Term
   els: Term
+  child_slots = ('cond', 'thn', 'els')
 
   def copy(self):
     return Conditional(self.location, self.typeof,
@@ -694,6 +842,7 @@ class Conditional(Term):
 class TAnnote(Term):
   subject: Term
   typ: Type
+  child_slots = ('subject',)
 
   def copy(self):
     return TAnnote(self.location, self.typeof, self.subject.copy(),
@@ -725,6 +874,7 @@ class Var(Term):
 
   # filled in during uniquify, list because of overloading
   resolved_names: list[str] = field(default_factory=list)
+  child_slots = ()
 
   def get_name(self):
     if len(self.resolved_names) > 0:
@@ -774,8 +924,9 @@ class Var(Term):
     return name2str(self.name)
         
   def reduce(self, env):
-      if get_reduce_all() or (self in get_reduce_only()):
-        if get_dont_reduce_opaque() and self.name in env.dict.keys():
+      ctx = reduction_context
+      if ctx.is_reducible(self.name):
+        if ctx.dont_reduce_opaque and self.name in env.dict.keys():
           binding = env.dict[self.name]
           if binding.visibility == 'opaque' \
              and binding.module != env.get_current_module():
@@ -823,12 +974,9 @@ class Var(Term):
       if import_advice != '':
           static_error(self.location, import_advice)
         
-      close_matches = []
-      for var in env.keys():
-        if edit_distance(self.name, var) <= ceil(len(self.name) / 5):
-          close_matches.append(var)
-      if len(close_matches) > 0:
-        mispell_advice = '\n\tdid you intend: ' + ', '.join(close_matches) + '\n'
+      suggestions = close_matches(self.name, env.keys(), ceil(len(self.name) / 5))
+      if len(suggestions) > 0:
+        mispell_advice = '\n\tdid you intend: ' + ', '.join(suggestions) + '\n'
       else:
         mispell_advice = ''
       static_error(self.location, 'undefined variable: ' + self.name \
@@ -867,6 +1015,7 @@ class Int(Term):
 class Lambda(Term):
   vars: List[Tuple[str,Type]]
   body: Term
+  child_slots = ('body',)
 
   def copy(self):
     return Lambda(self.location, self.typeof,
@@ -913,15 +1062,15 @@ class Lambda(Term):
                     self.body.substitute(sub))
 
   def uniquify(self, env):
-    body_env = {x:y for (x,y) in env.items()}
     for (x,t) in self.vars:
       if t:
         t.uniquify(env)
-    new_vars = [(generate_name(x),t) for (x,t) in self.vars]
-    for ((old,t1),(new,t2)) in zip(self.vars, new_vars):
-      overwrite(body_env, old, new, self.location)
-    self.vars = new_vars
-    self.body.uniquify(body_env)
+    with new_scope(env) as body_env:
+      new_vars = [(generate_name(x),t) for (x,t) in self.vars]
+      for ((old,t1),(new,t2)) in zip(self.vars, new_vars):
+        overwrite(body_env, old, new, self.location)
+      self.vars = new_vars
+      self.body.uniquify(body_env)
     
 def is_match(pattern, arg, subst):
     ret = False
@@ -976,47 +1125,82 @@ def is_match(pattern, arg, subst):
       print('is_match(' + str(pattern) + ', ' + str(arg) + ') = ' + str(ret))
     return ret
 
-# The variables that should be reduced.
-reduce_only = []
+class ReductionContext:
+  """The flags and the set of reducible names that control `reduce`.
 
-def set_reduce_only(defs):
-  global reduce_only
-  reduce_only = defs
+  The reducible names are kept as a multiset (name -> count) so that
+  function calls can make their parameters reducible and hide their
+  own name, then undo exactly that change when the call returns.
+  """
 
-def get_reduce_only():
-  global reduce_only
-  return reduce_only
+  def __init__(self):
+    self.reduce_all = False
+    self.eval_all = False
+    self.dont_reduce_opaque = False
+    self.reducible = {}
 
-reduce_all = False
+  def is_reducible(self, name):
+    return self.reduce_all or name in self.reducible
+
+  def _add(self, name):
+    self.reducible[name] = self.reducible.get(name, 0) + 1
+
+  def _remove(self, name):
+    count = self.reducible.get(name, 0)
+    if count == 0:
+      return False
+    if count == 1:
+      del self.reducible[name]
+    else:
+      self.reducible[name] = count - 1
+    return True
+
+  def hide(self, name):
+    """Make one occurrence of `name` not reducible.
+    Returns whether there was one to hide."""
+    return self._remove(name)
+
+  def unhide(self, name):
+    self._add(name)
+
+  def push_reducible(self, names, hide=None):
+    """Make `names` reducible and hide one occurrence of `hide`.
+    Returns a token to pass to `pop_reducible`."""
+    hidden = hide is not None and self._remove(hide)
+    for x in names:
+      self._add(x)
+    return (names, hide if hidden else None)
+
+  def pop_reducible(self, token):
+    names, hidden = token
+    for x in names:
+      self._remove(x)
+    if hidden is not None:
+      self._add(hidden)
+
+reduction_context = ReductionContext()
+
+def get_reduction_context():
+  global reduction_context
+  return reduction_context
 
 def get_reduce_all():
-  global reduce_all
-  return reduce_all
+  return reduction_context.reduce_all
 
 def set_reduce_all(b):
-  global reduce_all
-  reduce_all = b
-
-dont_reduce_opaque = False
+  reduction_context.reduce_all = b
 
 def get_dont_reduce_opaque():
-  global dont_reduce_opaque
-  return dont_reduce_opaque
+  return reduction_context.dont_reduce_opaque
 
 def set_dont_reduce_opaque(b):
-  global dont_reduce_opaque
-  dont_reduce_opaque = b
-
-eval_all = False
+  reduction_context.dont_reduce_opaque = b
 
 def get_eval_all():
-  # return False
-  global eval_all
-  return eval_all
+  return reduction_context.eval_all
 
 def set_eval_all(b):
-  global eval_all
-  eval_all = b
+  reduction_context.eval_all = b
 
 # Definitions that were reduced.
 reduced_defs = set()
@@ -1032,6 +1216,148 @@ def get_reduced_defs():
 def add_reduced_def(df):
   global reduced_defs
   reduced_defs.add(df)
+  for recorded in reduced_defs_recorders:
+    recorded.add(df)
+
+############ Structural keys of terms ##########################
+
+# The fields of each AST class that go into its key (everything but
+# the location).
+key_fields = {}
+
+def key_field_names(cls):
+  names = key_fields.get(cls)
+  if names is None:
+    names = [f.name for f in fields(cls) if f.name != 'location']
+    key_fields[cls] = names
+  return names
+
+def term_key(term, memo=None):
+  """A hashable key for the structure of a term (or type, pattern, etc.)
+
+  Two terms with the same key are equal up to locations. Recursive
+  functions are identified by their unique name.
+  """
+  if memo is None:
+    memo = {}
+  if isinstance(term, AST):
+    tid = id(term)
+    if tid in memo:
+      return memo[tid]
+    cls = type(term)
+    if isinstance(term, RecFun) or isinstance(term, GenRecFun):
+      key = (cls.__name__, term.name)
+    else:
+      key = (cls.__name__,) + tuple(term_key(getattr(term, x), memo)
+                                    for x in key_field_names(cls))
+    memo[tid] = key
+    return key
+  elif isinstance(term, list) or isinstance(term, tuple):
+    return tuple(term_key(t, memo) for t in term)
+  else:
+    return term
+
+def match_nodes(old, new, new_nodes, new_locs):
+  """Map each node of `old` to the node in the same position of `new`,
+  and each location of `old` to the location in the same position of
+  `new`, where they differ. The two must have the same key."""
+  if isinstance(old, AST):
+    if old is new or id(old) in new_nodes:
+      return
+    new_nodes[id(old)] = new
+    if old.location is not new.location:
+      new_locs.setdefault(id(old.location), new.location)
+    if not (isinstance(old, RecFun) or isinstance(old, GenRecFun)):
+      for x in key_field_names(type(old)):
+        match_nodes(getattr(old, x), getattr(new, x), new_nodes, new_locs)
+  elif isinstance(old, list) or isinstance(old, tuple):
+    for (a, b) in zip(old, new):
+      match_nodes(a, b, new_nodes, new_locs)
+
+def relocate(term, new_nodes, new_locs, memo):
+  """A copy of `term` in which each node whose id is in `new_nodes` is
+  replaced by the node it maps to, and each location whose id is in
+  `new_locs` by the location it maps to. The parts of `term` without
+  either are shared with it."""
+  if isinstance(term, AST):
+    tid = id(term)
+    if tid in new_nodes:
+      return new_nodes[tid]
+    if tid in memo:
+      return memo[tid]
+    ret = term
+    if not (isinstance(term, RecFun) or isinstance(term, GenRecFun)):
+      changes = {}
+      for x in key_field_names(type(term)):
+        old = getattr(term, x)
+        new = relocate(old, new_nodes, new_locs, memo)
+        if new is not old:
+          changes[x] = new
+      if id(term.location) in new_locs:
+        changes['location'] = new_locs[id(term.location)]
+      if len(changes) > 0:
+        ret = rebuild(term, changes)
+    memo[tid] = ret
+    return ret
+  elif isinstance(term, list) or isinstance(term, tuple):
+    new = [relocate(t, new_nodes, new_locs, memo) for t in term]
+    if any(a is not b for (a, b) in zip(term, new)):
+      return type(term)(new)
+    return term
+  else:
+    return term
+
+############ Normal-form cache for reduction ##########################
+
+# Maps the key of a reduction to the term that was reduced, the
+# result, and the definitions unfolded along the way.
+reduction_cache = {}
+reduction_cache_max = 20000
+
+def clear_reduction_cache():
+  reduction_cache.clear()
+
+# While a cached reduction is running, the definitions it reduces are
+# also recorded here, so that a cache hit can replay them.
+reduced_defs_recorders = []
+
+def cached_reduce(term, env):
+  """Reduce `term` in `env`, reusing the result of an earlier reduction
+  of the same term under the same definitions and reduction flags.
+
+  The result of the earlier reduction shares nodes with the earlier
+  term and copies its locations, so on a hit they are replaced by the
+  corresponding nodes and locations of `term`.
+  """
+  ctx = reduction_context
+  if ctx.eval_all or len(ctx.reducible) > 0 or get_verbose() \
+     or 'tracing' in env.dict:
+    return term.reduce(env)
+  key = (term_key(term), env.version,
+         ctx.reduce_all, ctx.dont_reduce_opaque)
+  entry = reduction_cache.get(key)
+  if entry is not None:
+    count('reduction cache', 'hits')
+    (old_term, result, defs) = entry
+    for df in defs:
+      add_reduced_def(df)
+    new_nodes = {}
+    new_locs = {}
+    match_nodes(old_term, term, new_nodes, new_locs)
+    if len(new_nodes) == 0:
+      return result
+    return relocate(result, new_nodes, new_locs, {})
+  count('reduction cache', 'misses')
+  defs = set()
+  reduced_defs_recorders.append(defs)
+  try:
+    result = term.reduce(env)
+  finally:
+    reduced_defs_recorders.pop()
+  if len(reduction_cache) >= reduction_cache_max:
+    del reduction_cache[next(iter(reduction_cache))]
+  reduction_cache[key] = (term, result, defs)
+  return result
 
 def complete_name(name):
     if base_name(name) in infix_precedence.keys() \
@@ -1112,6 +1438,8 @@ def op_arg_str(trm, arg):
 
 def do_function_call(loc, name, type_params, type_args,
                      params, args, body, subst, env, return_type):
+  count('function calls', base_name(name))
+  work['reductions'] += 1
   fast_call = False
   if get_eval_all() and len(args) == 2  and isNat(args[0]) and isNat(args[1]):
     op = base_name(name)
@@ -1167,23 +1495,16 @@ def do_function_call(loc, name, type_params, type_args,
       ret = body.reduce(env)
     else:
       new_fun_case_body = body.substitute(subst)
-      old_defs = get_reduce_only()
-      reduce_defs = [x for x in old_defs]
-      if Var(loc, None, name, []) in reduce_defs:
-        reduce_defs.remove(Var(loc, None, name, []))
-      else:
-        pass
-      reduce_defs += [Var(loc, None, x, [x]) for x in params]
+      # Don't unfold the function inside its own body,
+      # but do reduce the parameters.
       # Revisit the following -Jeremy  
-      # reduce_defs += [Var(loc, None, x, []) \
-      #                 for x in fun_case.pattern.parameters \
-      #                 + fun_case.parameters]
-      set_reduce_only(reduce_defs)
+      # also make fun_case.pattern.parameters + fun_case.parameters reducible
+      token = reduction_context.push_reducible(params, hide=name)
 
       # Reduce the body of the function
       ret = new_fun_case_body.reduce(body_env)
 
-      set_reduce_only(old_defs)
+      reduction_context.pop_reducible(token)
 
   add_reduced_def(name)
   if get_verbose():
@@ -1197,10 +1518,18 @@ def do_function_call(loc, name, type_params, type_args,
   return explicit_term_inst(ret)
 
 
+def call_span(name, env):
+  """A trace span around a call to the function `name`, if it is traced."""
+  if env.get_tracing(name):
+    return traced(base_name(name), 'call')
+  return nullcontext()
+
 @dataclass
 class Call(Term):
   rator: Term
   args: list[Term]
+  child_slots = ('rator', 'args')
+  derived_attrs = ('flattened',)
 
   def copy(self):
     ret = Call(self.location, self.typeof,
@@ -1255,7 +1584,7 @@ class Call(Term):
     else:
       is_assoc = is_associative(self.location, rator_name(self.rator),
                                 self.typeof, env)
-    if is_assoc:
+    if is_assoc and not is_flat_assoc(self):
       flat_args = flatten_assoc_list(rator_name(self.rator), self.args)
     else:
       flat_args = self.args
@@ -1270,8 +1599,8 @@ class Call(Term):
         else:
           ret = Call(self.location, self.typeof, fun, args)
       case Var(loc, ty, name, rs) if is_assoc:
-        ret = Call(self.location, self.typeof, fun,
-                   flatten_assoc_list(rator_name(self.rator), args))
+        ret = mk_flat_assoc(self.location, self.typeof, fun,
+                            flatten_assoc_list(rator_name(self.rator), args))
         if hasattr(self, 'type_args'):
           ret.type_args = self.type_args
             
@@ -1289,26 +1618,30 @@ class Call(Term):
           print('>' * recursion_depth, str(base_name(name)) + '(' + str(' '.join([str(x) for x in args]) + ')'))
 
         subst = {k: v for ((k,t),v) in zip(params, args)}
-        ret = do_function_call(loc, name, [], [], [x for (x,t) in params], args,
-                               body, subst, env, None)
+        with call_span(name, env):
+          ret = do_function_call(loc, name, [], [], [x for (x,t) in params], args,
+                                 body, subst, env, None)
     
       case TermInst(loc, tyof,
                     GenRecFun(loc2, name, typarams, params, returns,
                               measure, measure_ty, body, terminates),
                     type_args):
         subst = {k: v for ((k,t),v) in zip(params, args)}
-        ret = do_function_call(loc, name, typarams, type_args, [x for (x,t) in params], args,
-                               body, subst, env, None)
+        with call_span(name, env):
+          ret = do_function_call(loc, name, typarams, type_args, [x for (x,t) in params], args,
+                                 body, subst, env, None)
     
       case RecFun(loc, name, [], params, returns, cases):
-        ret = self.do_recursive_call(loc, name, fun, [], [], params, args,
-                                     returns, cases, is_assoc, env)
+        with call_span(name, env):
+          ret = self.do_recursive_call(loc, name, fun, [], [], params, args,
+                                       returns, cases, is_assoc, env)
       case TermInst(loc, tyof,
                     RecFun(loc2, name, typarams, params, returns, cases),
                     type_args):
-        ret = self.do_recursive_call(loc, name, fun, typarams, type_args,
-                                     params, args, returns, cases, is_assoc,
-                                     env)
+        with call_span(name, env):
+          ret = self.do_recursive_call(loc, name, fun, typarams, type_args,
+                                       params, args, returns, cases, is_assoc,
+                                       env)
       case Generic(loc2, tyof, typarams, body):
         error(self.location, 'in reduction, call to generic\n\t' + str(self))
       case _:
@@ -1362,8 +1695,8 @@ class Call(Term):
     if is_assoc:
       if get_verbose():
         print('not reducing recursive call to associative ' + str(fun))
-      return Call(self.location, self.typeof, fun,
-                 flatten_assoc_list(rator_name(fun), args))
+      return mk_flat_assoc(self.location, self.typeof, fun,
+                           flatten_assoc_list(rator_name(fun), args))
     else:
       if get_verbose():
         print('not reducing recursive call to ' + str(fun))
@@ -1377,8 +1710,8 @@ class Call(Term):
       print('\targs: ' + ', '.join([str(a) for a in args]))
       print('\tparams: ' + ', '.join([str(p) for p in params]))
 
-    old_reduce_only = get_reduce_only()
-    reduce_only = [x for x in old_reduce_only]
+    ctx = reduction_context
+    hidden = 0
     new_args = []
     worklist = args
     while len(worklist) > 1:
@@ -1398,10 +1731,8 @@ class Call(Term):
               #   print('call result: ' + str(result))
               worklist = [result] + worklist[len(fun_case.parameters):]
               did_call = True
-              rator_var = Var(loc, None, name, [])
-              if rator_var in reduce_only:
-                reduce_only.remove(rator_var)
-              set_reduce_only(reduce_only)
+              if ctx.hide(name):
+                hidden += 1
               break
       if not did_call:
         new_args.append(first_arg)
@@ -1409,7 +1740,8 @@ class Call(Term):
         break
       # if get_verbose():
       #   print('-----------------------------')
-    set_reduce_only(old_reduce_only)
+    for i in range(hidden):
+      ctx.unhide(name)
     # if get_verbose():
     #   print('end associative operator ' + str(fun))
     #   print('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>')
@@ -1422,9 +1754,7 @@ class Call(Term):
     if len(flat_results) == 1:
       return explicit_term_inst(flat_results[0])
     else:
-      return Call(self.location, self.typeof,
-                  fun,
-                  flat_results)
+      return mk_flat_assoc(self.location, self.typeof, fun, flat_results)
   
   def substitute(self, sub):
     ret = Call(self.location, self.typeof, self.rator.substitute(sub),
@@ -1443,6 +1773,7 @@ class Call(Term):
 class SwitchCase(AST):
   pattern: Pattern
   body: Term
+  child_slots = ('body',)
   
   def copy(self):
     return SwitchCase(self.location,
@@ -1470,16 +1801,16 @@ class SwitchCase(AST):
 
   def uniquify(self, env):
     self.pattern.uniquify(env)
-    body_env = {x:y for (x,y) in env.items()}
-    match self.pattern:
-      case PatternBool(loc, value):
-        pass
-      case PatternCons(loc, constr, params):
-        new_params = [generate_name(x) for x in params]
-        for (old,new) in zip(params, new_params):
-          overwrite(body_env, old, new, self.location)
-        self.pattern.parameters = new_params
-    self.body.uniquify(body_env)
+    with new_scope(env) as body_env:
+      match self.pattern:
+        case PatternBool(loc, value):
+          pass
+        case PatternCons(loc, constr, params):
+          new_params = [generate_name(x) for x in params]
+          for (old,new) in zip(params, new_params):
+            overwrite(body_env, old, new, self.location)
+          self.pattern.parameters = new_params
+      self.body.uniquify(body_env)
     
   def __eq__(self, other):
     if not isinstance(other, SwitchCase):
@@ -1500,6 +1831,7 @@ class SwitchCase(AST):
 class Switch(Term):
   subject: Term
   cases: List[SwitchCase]
+  child_slots = ('subject', 'cases')
 
   def copy(self):
     return Switch(self.location, self.typeof,
@@ -1531,11 +1863,9 @@ class Switch(Term):
             else:
               new_body = c.body.substitute(subst)
               new_env = env
-              old_defs = get_reduce_only()
-              set_reduce_only(old_defs + [Var(self.location, None, x, []) \
-                                          for x in subst.keys()])
+              token = reduction_context.push_reducible(list(subst.keys()))
               ret = new_body.reduce(new_env)
-              set_reduce_only(old_defs)
+              reduction_context.pop_reducible(token)
             return ret
       ret = Switch(self.location, self.typeof, new_subject, self.cases)
       return ret
@@ -1562,6 +1892,7 @@ class TermInst(Term):
   subject: Term
   type_args: List[Type]
   inferred : bool = True
+  child_slots = ('subject',)
 
   def __eq__(self, other):
     if isinstance(other, RecFun):
@@ -1674,6 +2005,7 @@ class MakeArray(Term):
 class ArrayGet(Term):
   subject: Term
   position: Term
+  child_slots = ('subject', 'position')
 
   def __eq__(self, other):
     if isinstance(other, ArrayGet):
@@ -1721,6 +2053,7 @@ class TLet(Term):
   var: str
   rhs: Term
   body: Term
+  child_slots = ('rhs', 'body')
 
   def __str__(self):
     return 'define ' + base_name(self.var) + ' = ' + str(self.rhs) + ';' \
@@ -1745,11 +2078,11 @@ class TLet(Term):
   
   def uniquify(self, env):
     self.rhs.uniquify(env)
-    body_env = {x:y for (x,y) in env.items()}
-    new_var = generate_name(self.var)
-    overwrite(body_env, self.var, new_var, self.location)
-    self.var = new_var
-    self.body.uniquify(body_env)
+    with new_scope(env) as body_env:
+      new_var = generate_name(self.var)
+      overwrite(body_env, self.var, new_var, self.location)
+      self.var = new_var
+      self.body.uniquify(body_env)
     
   def substitute(self, sub):
     new_rhs = self.rhs.substitute(sub)
@@ -1758,6 +2091,7 @@ class TLet(Term):
 
 @dataclass
 class Hole(Term):
+  child_slots = ()
   
   def __str__(self):
       return '?'
@@ -1776,6 +2110,7 @@ class Hole(Term):
 
 @dataclass
 class Omitted(Term):
+  child_slots = ()
   
   def __str__(self):
       return '--'
@@ -1795,6 +2130,7 @@ class Omitted(Term):
 @dataclass
 class Mark(Term):
   subject: Term
+  child_slots = ('subject',)
 
   def __eq__(self, other):
     if isinstance(other, Mark):
@@ -1826,6 +2162,7 @@ class Mark(Term):
 @dataclass
 class Bool(Formula):
   value: bool
+  child_slots = ()
   
   def copy(self):
     return Bool(self.location, self.typeof, self.value)
@@ -1867,6 +2204,7 @@ def is_true(b):
 @dataclass
 class And(Formula):
   args: list[Formula]
+  child_slots = ('args',)
 
   def copy(self):
     return And(self.location, self.typeof, [arg.copy() for arg in self.args])
@@ -1948,6 +2286,7 @@ def flatten_or(args):
 @dataclass
 class Or(Formula):
   args: list[Formula]
+  child_slots = ('args',)
   def copy(self):
     return Or(self.location, self.typeof, [arg.copy() for arg in self.args])
   
@@ -2000,6 +2339,7 @@ class Or(Formula):
 class IfThen(Formula):
   premise: Formula
   conclusion : Formula
+  child_slots = ('premise', 'conclusion')
   
   def copy(self):
     return IfThen(self.location, self.typeof, self.premise.copy(),
@@ -2067,6 +2407,7 @@ class All(Formula):
   #  e : The number of vars in the block
   pos: Tuple[int, int]
   body: Formula
+  child_slots = ('body',)
 
   def copy(self):
     x, t = self.var
@@ -2127,19 +2468,20 @@ class All(Formula):
     return result
 
   def uniquify(self, env):
-    body_env = {x:y for (x,y) in env.items()}
-    (x,ty) = self.var
-    t = ty.copy()
-    t.uniquify(body_env)
-    new_x = generate_name(x)
-    overwrite(body_env, x, new_x, self.location)
-    self.var = (new_x,t)
-    self.body.uniquify(body_env)
+    with new_scope(env) as body_env:
+      (x,ty) = self.var
+      t = ty.copy()
+      t.uniquify(body_env)
+      new_x = generate_name(x)
+      overwrite(body_env, x, new_x, self.location)
+      self.var = (new_x,t)
+      self.body.uniquify(body_env)
     
 @dataclass
 class Some(Formula):
   vars: list[Tuple[str,Type]]
   body: Formula
+  child_slots = ('body',)
 
   def copy(self):
     return Some(self.location,
@@ -2175,16 +2517,16 @@ class Some(Formula):
                 self.body.substitute(new_sub))
   
   def uniquify(self, env):
-    body_env = {x:y for (x,y) in env.items()}
-    new_vars = []
-    for (x,ty) in self.vars:
-      t = ty.copy()
-      t.uniquify(body_env)
-      new_x = generate_name(x)
-      new_vars.append( (new_x,t) )
-      overwrite(body_env, x, new_x, self.location)
-    self.vars = new_vars
-    self.body.uniquify(body_env)
+    with new_scope(env) as body_env:
+      new_vars = []
+      for (x,ty) in self.vars:
+        t = ty.copy()
+        t.uniquify(body_env)
+        new_x = generate_name(x)
+        new_vars.append( (new_x,t) )
+        overwrite(body_env, x, new_x, self.location)
+      self.vars = new_vars
+      self.body.uniquify(body_env)
     
   def __eq__(self, other):
     if not isinstance(other, Some):
@@ -2248,11 +2590,11 @@ class PLet(Proof):
   def uniquify(self, env):
     self.proved.uniquify(env)
     self.because.uniquify(env)
-    body_env = {x:y for (x,y) in env.items()}
-    new_label = generate_name(self.label)
-    overwrite(body_env, self.label, new_label, self.location)
-    self.label = new_label
-    self.body.uniquify(body_env)
+    with new_scope(env) as body_env:
+      new_label = generate_name(self.label)
+      overwrite(body_env, self.label, new_label, self.location)
+      self.label = new_label
+      self.body.uniquify(body_env)
 
 @dataclass
 class PTLetNew(Proof):
@@ -2273,11 +2615,11 @@ class PTLetNew(Proof):
 
   def uniquify(self, env):
     self.rhs.uniquify(env)
-    body_env = {x:y for (x,y) in env.items()}
-    new_var = generate_name(self.var)
-    overwrite(body_env, self.var, new_var, self.location)
-    self.var = new_var
-    self.body.uniquify(body_env)
+    with new_scope(env) as body_env:
+      new_var = generate_name(self.var)
+      overwrite(body_env, self.var, new_var, self.location)
+      self.var = new_var
+      self.body.uniquify(body_env)
     
     
 @dataclass
@@ -2361,15 +2703,15 @@ class Cases(Proof):
     i = 0
     new_cases = []
     while i != len(self.cases):
-      body_env = {x:y for (x,y) in env.items()}
       label = self.cases[i][0]
       formula = self.cases[i][1]
       proof = self.cases[i][2]
       if formula:
         formula.uniquify(env)
       new_label = generate_name(label)
-      overwrite(body_env, label, new_label, self.location)
-      proof.uniquify(body_env)
+      with new_scope(env) as body_env:
+        overwrite(body_env, label, new_label, self.location)
+        proof.uniquify(body_env)
       new_cases.append((new_label, formula, proof))
       i += 1
     self.cases = new_cases
@@ -2414,11 +2756,11 @@ class ImpIntro(Proof):
   def uniquify(self, env):
     if self.premise:
       self.premise.uniquify(env)
-    body_env = copy_dict(env)
-    new_label = generate_name(self.label)
-    overwrite(body_env, self.label, new_label, self.location)
-    self.label = new_label
-    self.body.uniquify(body_env)
+    with new_scope(env) as body_env:
+      new_label = generate_name(self.label)
+      overwrite(body_env, self.label, new_label, self.location)
+      self.label = new_label
+      self.body.uniquify(body_env)
     
 @dataclass
 class AllIntro(Proof):
@@ -2453,14 +2795,14 @@ class AllIntro(Proof):
     return self.arbitrary_str() + maybe_str(self.body)
 
   def uniquify(self, env):
-    body_env = copy_dict(env)
-    x, ty = self.var
-    new_t = ty.copy()
-    new_t.uniquify(body_env)
-    new_x = generate_name(x)
-    overwrite(body_env, x, new_x, self.location)
-    self.var = (new_x, new_t)
-    self.body.uniquify(body_env)
+    with new_scope(env) as body_env:
+      x, ty = self.var
+      new_t = ty.copy()
+      new_t.uniquify(body_env)
+      new_x = generate_name(x)
+      overwrite(body_env, x, new_x, self.location)
+      self.var = (new_x, new_t)
+      self.body.uniquify(body_env)
 
   def set_body(self, new_body):
     if self.body:
@@ -2581,19 +2923,19 @@ class SomeElim(Proof):
   
   def uniquify(self, env):
     self.some.uniquify(env)
-    body_env = copy_dict(env)
-    new_witnesses = []
-    for x in self.witnesses:
-      new_x = generate_name(x)
-      new_witnesses.append( new_x )
-      overwrite(body_env, x, new_x, self.location)
-    new_label = generate_name(self.label)
-    overwrite(body_env, self.label, new_label, self.location)
-    self.witnesses = new_witnesses
-    self.label = new_label
-    if self.prop:
-      self.prop.uniquify(body_env)
-    self.body.uniquify(body_env)
+    with new_scope(env) as body_env:
+      new_witnesses = []
+      for x in self.witnesses:
+        new_x = generate_name(x)
+        new_witnesses.append( new_x )
+        overwrite(body_env, x, new_x, self.location)
+      new_label = generate_name(self.label)
+      overwrite(body_env, self.label, new_label, self.location)
+      self.witnesses = new_witnesses
+      self.label = new_label
+      if self.prop:
+        self.prop.uniquify(body_env)
+      self.body.uniquify(body_env)
     
 @dataclass
 class PTuple(Proof):
@@ -2806,23 +3148,23 @@ class IndCase(AST):
       + '{' + str(self.body) + '}'
 
   def uniquify(self, env):
-    body_env = copy_dict(env)
-
-    new_params = [generate_name(x) for x in self.pattern.parameters]
-    for (old,new) in zip(self.pattern.parameters, new_params):
-      overwrite(body_env, old, new, self.location)
-
-    new_hyps = [(generate_name(x),f) for (x,f) in self.induction_hypotheses]
-    for ((old,old_frm),(new,new_frm)) in zip(self.induction_hypotheses, new_hyps):
-      overwrite(body_env, old, new, self.location)
-    for (x,f) in new_hyps:
-      if f:
-        f.uniquify(body_env)
+    with new_scope(env) as body_env:
+
+      new_params = [generate_name(x) for x in self.pattern.parameters]
+      for (old,new) in zip(self.pattern.parameters, new_params):
+        overwrite(body_env, old, new, self.location)
+
+      new_hyps = [(generate_name(x),f) for (x,f) in self.induction_hypotheses]
+      for ((old,old_frm),(new,new_frm)) in zip(self.induction_hypotheses, new_hyps):
+        overwrite(body_env, old, new, self.location)
+      for (x,f) in new_hyps:
+        if f:
+          f.uniquify(body_env)
       
-    self.pattern.parameters = new_params
-    self.pattern.uniquify(body_env)
-    self.induction_hypotheses = new_hyps
-    self.body.uniquify(body_env)
+      self.pattern.parameters = new_params
+      self.pattern.uniquify(body_env)
+      self.induction_hypotheses = new_hyps
+      self.body.uniquify(body_env)
     
 @dataclass
 class Induction(Proof):
@@ -2866,22 +3208,22 @@ class SwitchProofCase(AST):
 
   def uniquify(self, env):
     self.pattern.uniquify(env)
-    body_env = copy_dict(env)
+    with new_scope(env) as body_env:
     
-    new_params = [generate_name(x) for x in self.pattern.bindings()]
-    for (old,new) in zip(self.pattern.bindings(), new_params):
-      overwrite(body_env, old, new, self.location)
-
-    new_assumptions = [(generate_name(x),f) for (x,f) in self.assumptions]
-    for (x,f) in new_assumptions:
-      if f:
-        f.uniquify(body_env)
-    for ((old,old_frm),(new,new_frm)) in zip(self.assumptions, new_assumptions):
-      overwrite(body_env, old, new, self.location)
-
-    self.pattern.set_bindings(new_params)
-    self.assumptions = new_assumptions
-    self.body.uniquify(body_env)
+      new_params = [generate_name(x) for x in self.pattern.bindings()]
+      for (old,new) in zip(self.pattern.bindings(), new_params):
+        overwrite(body_env, old, new, self.location)
+
+      new_assumptions = [(generate_name(x),f) for (x,f) in self.assumptions]
+      for (x,f) in new_assumptions:
+        if f:
+          f.uniquify(body_env)
+      for ((old,old_frm),(new,new_frm)) in zip(self.assumptions, new_assumptions):
+        overwrite(body_env, old, new, self.location)
+
+      self.pattern.set_bindings(new_params)
+      self.assumptions = new_assumptions
+      self.body.uniquify(body_env)
     
 @dataclass
 class SwitchProof(Proof):
@@ -3122,13 +3464,9 @@ class Constructor(AST):
   def pretty_print(self, indent):
       return indent*' ' + str(self)
   
-  def uniquify(self, env, body_env):
+  def uniquify(self, env):
     for ty in self.parameters:
-      ty.uniquify(body_env)
-
-    new_name = generate_name(self.name)
-    extend(env, self.name, new_name, self.location)
-    self.name = new_name
+      ty.uniquify(env)
       
   def __str__(self):
     if get_verbose():
@@ -3158,14 +3496,20 @@ class Union(Declaration):
     env['no overload'][self.name] = 'union'
     self.name = new_name
     
-    body_env = copy_dict(env)
     new_type_params = [generate_name(t) for t in self.type_params]
-    for (old,new) in zip(self.type_params, new_type_params):
-      extend(body_env, old, new, self.location)
+    with new_scope(env) as body_env:
+      for (old,new) in zip(self.type_params, new_type_params):
+        extend(body_env, old, new, self.location)
+      for con in self.alternatives:
+        con.uniquify(body_env)
     self.type_params = new_type_params
-    
+
+    # The constructors are in scope after the union, unlike its type
+    # parameters.
     for con in self.alternatives:
-      con.uniquify(env, body_env)
+      new_name = generate_name(con.name)
+      extend(env, con.name, new_name, con.location)
+      con.name = new_name
 
   def collect_exports(self, export_env, importing_module):
     if self.visibility == 'private' and importing_module != get_current_module():
@@ -3222,23 +3566,23 @@ class FunCase(AST):
               '", not "' + str(self.rator.name) + '"')
     self.rator.uniquify(env)
     self.pattern.uniquify(env)
-    body_env = copy_dict(env)
-
-    match self.pattern:
-      case PatternCons(loc, cons, parameters):
-        new_pat_params = [generate_name(x) for x in parameters]
-        for (old,new) in zip(parameters, new_pat_params):
-          overwrite(body_env, old, new, self.location)
-        self.pattern.parameters = new_pat_params
-      case PatternBool(loc, b):
-        pass
-
-    new_params = [generate_name(x) for x in self.parameters]
-    for (old,new) in zip(self.parameters, new_params):
-      overwrite(body_env, old, new, self.location)
-    self.parameters = new_params
-
-    self.body.uniquify(body_env)
+    with new_scope(env) as body_env:
+
+      match self.pattern:
+        case PatternCons(loc, cons, parameters):
+          new_pat_params = [generate_name(x) for x in parameters]
+          for (old,new) in zip(parameters, new_pat_params):
+            overwrite(body_env, old, new, self.location)
+          self.pattern.parameters = new_pat_params
+        case PatternBool(loc, b):
+          pass
+
+      new_params = [generate_name(x) for x in self.parameters]
+      for (old,new) in zip(self.parameters, new_params):
+        overwrite(body_env, old, new, self.location)
+      self.parameters = new_params
+
+      self.body.uniquify(body_env)
     
     
 @dataclass
@@ -3248,6 +3592,7 @@ class RecFun(Declaration):
   params: List[Type]
   returns: Type
   cases: List[FunCase]
+  child_slots = ()
 
   def uniquify(self, env):
     # print('uniquifying recursive')
@@ -3258,22 +3603,22 @@ class RecFun(Declaration):
     extend(env, self.name, new_name, self.location)
     self.name = new_name
     
-    body_env = copy_dict(env)
-    new_type_params = [generate_name(t) for t in self.type_params]
-    for (old,new) in zip(self.type_params, new_type_params):
-      extend(body_env, old, new, self.location)
-    self.old_type_params = self.type_params
-    self.type_params = new_type_params
+    with new_scope(env) as body_env:
+      new_type_params = [generate_name(t) for t in self.type_params]
+      for (old,new) in zip(self.type_params, new_type_params):
+        extend(body_env, old, new, self.location)
+      self.old_type_params = self.type_params
+      self.type_params = new_type_params
     
-    for ty in self.params:
-      ty.uniquify(body_env)
-    self.returns.uniquify(body_env)
+      for ty in self.params:
+        ty.uniquify(body_env)
+      self.returns.uniquify(body_env)
 
-    for c in self.cases:
-      c.uniquify(body_env, old_name)
+      for c in self.cases:
+        c.uniquify(body_env, old_name)
 
-    # print('finished uniquifying recursive')
-    # print(self.pretty_print(0))
+      # print('finished uniquifying recursive')
+      # print(self.pretty_print(0))
       
   def collect_exports(self, export_env, importing_module):
     if self.visibility == 'private' and importing_module != get_current_module():
@@ -3353,6 +3698,7 @@ class GenRecFun(Declaration):
   measure_ty: Type
   body: Term
   terminates: Proof
+  child_slots = ()
 
   def uniquify(self, env):
     # print('uniquifying recfun')
@@ -3363,31 +3709,32 @@ class GenRecFun(Declaration):
     extend(env, self.name, new_name, self.location)
     self.name = new_name
     
-    body_env = copy_dict(env)
-    terminates_env = copy_dict(env)
     new_type_params = [generate_name(t) for t in self.type_params]
-    for (old,new) in zip(self.type_params, new_type_params):
-      extend(body_env, old, new, self.location)
-      extend(terminates_env, old, new, self.location)
     self.old_type_params = self.type_params
-    self.type_params = new_type_params
-    
-    self.returns.uniquify(body_env)
+    with new_scope(env) as body_env:
+      for (old,new) in zip(self.old_type_params, new_type_params):
+        extend(body_env, old, new, self.location)
+      self.returns.uniquify(body_env)
     
-    for (x,t) in self.vars:
-      if t:
-        t.uniquify(body_env)
-    new_vars = [(generate_name(x),t) for (x,t) in self.vars]
-    for ((old,t1),(new,t2)) in zip(self.vars, new_vars):
-      overwrite(body_env, old, new, self.location)
-    self.vars = new_vars
-
-    self.measure.uniquify(body_env)
+      for (x,t) in self.vars:
+        if t:
+          t.uniquify(body_env)
+      new_vars = [(generate_name(x),t) for (x,t) in self.vars]
+      for ((old,t1),(new,t2)) in zip(self.vars, new_vars):
+        overwrite(body_env, old, new, self.location)
+      self.vars = new_vars
+
+      self.measure.uniquify(body_env)
+      #extend(body_env, old_name, new_name, self.location)
+      self.body.uniquify(body_env)
+    self.type_params = new_type_params
     self.measure_ty.uniquify(env)
-    self.terminates.uniquify(terminates_env)
-    
-    #extend(body_env, old_name, new_name, self.location)
-    self.body.uniquify(body_env)
+
+    # The proof of termination only sees the type parameters.
+    with new_scope(env) as terminates_env:
+      for (old,new) in zip(self.old_type_params, new_type_params):
+        extend(terminates_env, old, new, self.location)
+      self.terminates.uniquify(terminates_env)
 
     # print('finished uniquifying recfun')
     # print(self.pretty_print(0))
@@ -3587,10 +3934,12 @@ class Import(Declaration):
         from parser import get_filename, set_filename, parse
       old_filename = get_filename()
       set_filename(filename)
-      self.ast = parse(src, trace=False)
+      with profile_phase(self.name, 'parse'):
+        self.ast = parse(src, trace=False)
       uniquified_modules[self.name] = self.ast
       set_filename(old_filename)
-      uniquify_deduce(self.ast)
+      with profile_phase(self.name, 'uniquify'):
+        uniquify_deduce(self.ast)
 
     env['__module__' + self.name] = None
     if get_verbose():
@@ -3684,12 +4033,12 @@ class Associative(Statement):
 
   def uniquify(self, env):
     self.op.uniquify(env)
-    body_env = {x:y for (x,y) in env.items()}
-    new_type_params = [generate_name(x) for x in self.type_params]
-    for (old,new) in zip(self.type_params, new_type_params):
-      overwrite(body_env, old, new, self.location)
-    self.type_params = new_type_params
-    self.typeof.uniquify(body_env)
+    with new_scope(env) as body_env:
+      new_type_params = [generate_name(x) for x in self.type_params]
+      for (old,new) in zip(self.type_params, new_type_params):
+        overwrite(body_env, old, new, self.location)
+      self.type_params = new_type_params
+      self.typeof.uniquify(body_env)
 
   def collect_exports(self, export_env, importing_module):
     opname = self.op.resolved_names[0]
@@ -4100,6 +4449,8 @@ class ProofBinding(Binding):
 @dataclass
 class AutoEquationBinding(Binding):
   equations : List[Formula]
+  # discrimination tree for each list of equations in `equations`
+  indexes : dict = field(default_factory=dict, compare=False)
   
   def __str__(self):
     return ', '.join([str(e) for e in self.equations])
@@ -4115,18 +4466,88 @@ def type_params_str(type_params):
 class AssociativeBinding(Binding):
   opname: str
   types: List[Tuple[List[str], Type]]
+  # whether the operator is associative at a type, by the type's key.
+  # A new binding is made for each associative declaration.
+  cache: dict = field(default_factory=dict, compare=False)
 
   def __str__(self):
     return 'associative ' + self.opname \
       + ' ' + ', '.join(type_params_str(type_params) + str(t) \
                         for (type_params, t) in self.types)
 
+class Givens:
+  """The local proof bindings of an environment, in the order they were
+  declared, with an index from the key of each formula to the positions
+  of its proofs. The environments derived from one another share one
+  list of bindings, each seeing the first `length` of them. A new local
+  proof is appended in place, unless another environment has already
+  appended past this one, in which case the list is copied first."""
+  def __init__(self, entries = None, index = None, length = 0):
+    self.entries = entries if entries is not None else []
+    self.index = index if index is not None else {}
+    self.length = length
+
+  def add(self, name, binding):
+    if self.length < len(self.entries):
+      count('Givens', 'copies')
+      givens = Givens()
+      for (n, b) in self.entries[:self.length]:
+        givens = givens.add(n, b)
+      return givens.add(name, binding)
+    self.entries.append((name, binding))
+    self.index.setdefault(term_key(binding.formula), []).append(self.length)
+    return Givens(self.entries, self.index, self.length + 1)
+
+  def bindings(self):
+    """The last binding of each label, in the order the labels were
+    first given."""
+    latest = {}
+    for (name, b) in self.entries[:self.length]:
+      latest[name] = b
+    return latest
+
+  def with_key(self, key):
+    """The labels and bindings of the givens whose formula has `key`."""
+    return [self.entries[i] for i in self.index.get(key, []) if i < self.length]
+
+# Each environment gets a version number, which is shared with the
+# environments derived from it that bind only proofs, so that the
+# reduction cache can tell when the definitions might differ.
+env_version = 0
+
+def next_env_version():
+  global env_version
+  env_version += 1
+  return env_version
+
 class Env:
-  def __init__(self, env = None):
-    if env:
+  def __init__(self, env = None, version = None):
+    if isinstance(env, Env):
+      count('Env', 'copies')
+      self.dict = copy_dict(env.dict)
+      self._givens = env._givens
+    elif env:
+      count('Env', 'copies')
       self.dict = copy_dict(env)
+      self._givens = None
     else:
       self.dict = {}
+      self._givens = Givens()
+    self.version = version if version is not None else next_env_version()
+
+  def givens(self):
+    if self._givens is None:
+      givens = Givens()
+      for (name, b) in self.dict.items():
+        if isinstance(b, ProofBinding) and b.local:
+          givens = givens.add(name, b)
+      self._givens = givens
+    return self._givens
+
+  def local_proof_bindings(self):
+    # A given may have been overwritten by a later binding of its label.
+    return [(name, b) for (name, b) in self.givens().bindings().items() \
+            if self.dict.get(name) is b]
 
   # This is a hack. Not reliable. Added for GenRecFun.
   def base_to_unique(self, name):
@@ -4150,9 +4571,12 @@ class Env:
     return item in self.dict.keys()
     
   def proofs_str(self):
+    if get_verbose() == VerboseLevel.FULL:
+      return ',\n'.join(['\t' + name2str(k) + ': ' + str(v) \
+                         for (k,v) in reversed(self.dict.items()) \
+                         if isinstance(v,ProofBinding)])
     return ',\n'.join(['\t' + name2str(k) + ': ' + str(v) \
-                       for (k,v) in reversed(self.dict.items()) \
-                       if isinstance(v,ProofBinding) and (v.local or get_verbose() == VerboseLevel.FULL)])
+                       for (k,v) in reversed(self.local_proof_bindings())])
 
   def term_vars_str(self):
     return ',\n'.join(['\t' + base_name(k) + ': ' + str(v.typ) \
@@ -4160,7 +4584,7 @@ class Env:
                        if isinstance(v,TermBinding) and v.local])
   
   def declare_type(self, loc, name, vis = 'public'):
-    new_env = Env(self.dict)
+    new_env = Env(self)
     new_env.dict[name] = TypeBinding(loc, module=self.get_current_module(), visibility=vis)
     return new_env
 
@@ -4173,21 +4597,21 @@ class Env:
   def define_type(self, loc, name, defn, visibility = 'public'):
     if defn == None:
       error(loc, 'None not allowed in define_type')
-    new_env = Env(self.dict)
+    new_env = Env(self)
     new_env.dict[name] = TypeBinding(loc, defn, module=self.get_current_module(), visibility=visibility)
     return new_env
   
   def declare_term_var(self, loc, name, typ, local = False, visibility='public'):
     if typ == None:
       error(loc, 'None not allowed as type of variable in declare_term_var')
-    new_env = Env(self.dict)
+    new_env = Env(self)
     new_env.dict[name] = TermBinding(loc, typ, module=self.get_current_module(), visibility=visibility)
     new_env.dict[name].local = local
     return new_env
 
   def declare_assoc(self, loc, opname, typarams, typ):
     #print('declaring assoc ' + opname + ' ' + str(typ))
-    new_env = Env(self.dict)
+    new_env = Env(self)
     full_name = '__associative_' + opname
     if full_name in new_env:
       old = new_env.dict[full_name]
@@ -4199,23 +4623,32 @@ class Env:
     return new_env
 
   def declare_auto_rewrite(self, loc, equation):
-    new_env = Env(self.dict)
+    # The equations are shared with the environments this one was
+    # derived from, so results cached for them are no longer valid.
+    clear_reduction_cache()
+    new_env = Env(self)
     full_name = '__auto__'
-    (lhs,rhs) = split_equation(loc, equation, new_env)
-    head_lhs = term_head(lhs)
+    rule = RewriteRule(loc, equation, new_env)
+    head_lhs = term_head(rule.lhs)
     #print('declare auto: ' + head_lhs + '\n\t' + str(equation))
     if full_name in self.dict:
-        if head_lhs in new_env.dict[full_name].equations:
-            new_env.dict[full_name].equations[head_lhs].append(equation)
+        binding = new_env.dict[full_name]
+        if head_lhs in binding.equations:
+            binding.equations[head_lhs].append(equation)
         else:
-            new_env.dict[full_name].equations[head_lhs] = [equation]
+            binding.equations[head_lhs] = [equation]
+            binding.indexes[head_lhs] = DiscriminationTree()
     else:
         new_equations = {}
         new_equations[head_lhs] = [equation]
         if 'no_name' not in new_equations:
             new_equations['no_name'] = []
-        new_env.dict[full_name] = AutoEquationBinding(loc, new_equations,
-                                                      module=self.get_current_module())
+        binding = AutoEquationBinding(loc, new_equations,
+                                      module=self.get_current_module())
+        for head in new_equations.keys():
+          binding.indexes[head] = DiscriminationTree()
+        new_env.dict[full_name] = binding
+    binding.indexes[head_lhs].insert(rule, new_env)
     return new_env
 
   def get_auto_rewrites(self, head):
@@ -4228,8 +4661,24 @@ class Env:
     else:
       return []
 
+  def get_auto_rewrite_candidates(self, term, head, assoc):
+    """The rewrite rules of the auto equations for `head` whose
+    left-hand side could match `term`, in the order they were declared.
+    An associative call can also be rewritten in a window of its
+    arguments, so it gets all of them."""
+    full_name = '__auto__'
+    if full_name in self.dict.keys():
+        binding = self.dict[full_name]
+        if head not in binding.equations:
+          head = 'no_name'
+        if assoc:
+          return binding.indexes[head].rules
+        return binding.indexes[head].retrieve(term)
+    else:
+      return []
+
   def declare_inductive(self, loc, ind_dict, thm):
-    new_env = Env(self.dict)
+    new_env = Env(self)
     full_name = '__inductive__'
     typ = ind_dict["ind_ty"]
     ind_dict["thm"] = thm
@@ -4268,7 +4717,7 @@ class Env:
       error(loc, 'None not allowed as type in define_term_var')
     if val == None:
       error(loc, 'None not allowed as value in define_term_var')
-    new_env = Env(self.dict)
+    new_env = Env(self)
     new_env.dict[name] = TermBinding(loc, typ, val, module=self.get_current_module(),
                                      visibility=visibility)
     return new_env
@@ -4280,22 +4729,24 @@ class Env:
     return new_env
   
   def declare_proof_var(self, loc, name, frm):
-    new_env = Env(self.dict)
+    new_env = Env(self, self.version)
     new_env.dict[name] = ProofBinding(loc, frm, False, module=self.get_current_module())
     return new_env
 
   def declare_local_proof_var(self, loc, name, frm):
-    new_env = Env(self.dict)
-    new_env.dict[name] = ProofBinding(loc, frm, True, module=self.get_current_module())
+    new_env = Env(self, self.version)
+    binding = ProofBinding(loc, frm, True, module=self.get_current_module())
+    new_env.dict[name] = binding
+    new_env._givens = self.givens().add(name, binding)
     return new_env
 
   def declare_module(self, module):
-    new_env = Env(self.dict)
+    new_env = Env(self)
     new_env.dict['__current_module__'] = module
     return new_env
   
   def declare_tracing(self, function_name: str):
-    new_env = Env(self.dict)
+    new_env = Env(self)
     if 'tracing' not in new_env.dict:
       new_env.dict['tracing'] = set()
     new_env.dict['tracing'].add(function_name)
@@ -4390,6 +4841,9 @@ class Env:
       return self.dict['__associative_' + opname].types
     else:
       return []
+
+  def get_assoc_binding(self, opname):
+    return self.dict.get('__associative_' + opname)
       
   def get_def_of_type_var(self, var):
     match var:
@@ -4430,8 +4884,21 @@ class Env:
     return 'tracing' in self.dict and function_name in self.dict['tracing']
 
   def local_proofs(self):
-    return [b.formula for (name, b) in self.dict.items() \
-            if isinstance(b, ProofBinding) and b.local]
+    return [b.formula for (name, b) in self.local_proof_bindings()]
+
+  def has_local_proof(self, frm):
+    for (name, b) in self.givens().with_key(term_key(frm)):
+      if self.dict.get(name) is b:
+        return True
+    # The formulas may be equal without having the same key.
+    return frm in self.local_proofs()
+
+  def find_local_proof(self, frm):
+    """The label of the first local proof of `frm`, or None."""
+    for (name, b) in self.local_proof_bindings():
+      if b.formula == frm:
+        return name
+    return None
 
   def proofs(self):
     return [b.formula for (name, b) in self.dict.items() \
@@ -4500,176 +4967,45 @@ def get_default_mark_LHS():
   return default_mark_LHS
 
 @dataclass
-class MarkException(BaseException):
-    subject: Term
-
-def count_marks(formula):
-  match formula:
-    case Mark(loc2, tyof, subject):
-      return 1 + count_marks(subject)
-    case TermInst(loc2, tyof, subject, tyargs, inferred):
-      return count_marks(subject)
-    case Var(loc2, tyof, name):
-      return 0
-    case Bool(loc2, tyof, val):
-      return 0
-    case And(loc2, tyof, args):
-      return sum([count_marks(arg) for arg in args])
-    case Or(loc2, tyof, args):
-      return sum([count_marks(arg) for arg in args])
-    case IfThen(loc2, tyof, prem, conc):
-      return count_marks(prem) + count_marks(conc)
-    case All(loc2, tyof, var, _, frm2):
-      return count_marks(frm2)
-    case Some(loc2, tyof, vars, frm2):
-      return count_marks(frm2)
-    case Call(loc2, tyof, rator, args):
-      return count_marks(rator) + sum([count_marks(arg) for arg in args])
-    case Switch(loc2, tyof, subject, cases):
-      return count_marks(subject) + sum([count_marks(c) for c in cases])
-    case SwitchCase(loc2, pat, body):
-      return count_marks(body)
-    case RecFun(loc, name, typarams, params, returns, cases):
-      return 0
-    case GenRecFun(loc, name, typarams, params, returns, measure, measure_ty, body, trm):
-      return 0
-    case Conditional(loc2, tyof, cond, thn, els):
-      return count_marks(cond) + count_marks(thn) + count_marks(els)
-    case Lambda(loc2, tyof, vars, body):
-      return count_marks(body)
-    case Generic(loc2, tyof, typarams, body):
-      return count_marks(body)
-    case TAnnote(loc2, tyof, subject, typ):
-      return count_marks(subject)
-    case TLet(loc2, tyof, var, rhs, body):
-      return count_marks(rhs) + count_marks(body)
-    case Hole(loc2, tyof):
-      return 0
-    case Omitted(loc2, tyof):
-      return 0
-    case ArrayGet(loc, tyof, arr, ind):
-      return count_marks(arr) + count_marks(ind)
-    case _:
-      error(formula.location, 'in count_marks function, unhandled ' + str(formula))
+class MarkContext:
+  """Where the first mark of a formula is: the marked subject, the path
+  of (node, child index) steps leading to it, and how many marks the
+  formula contains in total."""
+  num_marks: int = 0
+  subject: Term = None
+  path: list = field(default_factory=list)
+
+  def plug(self, replacement):
+    """Rebuild the formula with `replacement` in place of the mark.
+    Only the nodes on the path are rebuilt."""
+    ret = replacement
+    for (node, i) in reversed(self.path):
+      ret = replace_child(node, i, ret)
+    return ret
 
-def find_mark(formula):
-  match formula:
-    case Mark(loc2, tyof, subject):
-      raise MarkException(subject)
-    case TermInst(loc2, tyof, subject, tyargs, inferred):
-      find_mark(subject)
-    case Var(loc2, tyof, name):
-      pass
-    case Bool(loc2, tyof, val):
-      pass
-    case And(loc2, tyof, args):
-      for arg in args:
-          find_mark(arg)
-    case Or(loc2, tyof, args):
-      for arg in args:
-          find_mark(arg)
-    case IfThen(loc2, tyof, prem, conc):
-      find_mark(prem)
-      find_mark(conc)
-    case All(loc2, tyof, var, pos, frm2):
-      find_mark(frm2)
-    case Some(loc2, tyof, vars, frm2):
-      find_mark(frm2)
-    case Call(loc2, tyof, rator, args):
-      find_mark(rator)
-      for arg in args:
-          find_mark(arg)
-    case Switch(loc2, tyof, subject, cases):
-      find_mark(subject)
-      for c in cases:
-          find_mark(c)
-    case SwitchCase(loc2, pat, body):
-      find_mark(body)
-    case RecFun(loc, name, typarams, params, returns, cases):
-      pass
-    case Conditional(loc2, tyof, cond, thn, els):
-      find_mark(cond)
-      find_mark(thn)
-      find_mark(els)
-    case Lambda(loc2, tyof, vars, body):
-      find_mark(body)
-    case Generic(loc2, tyof, typarams, body):
-      find_mark(body)
-    case TAnnote(loc2, tyof, subject, typ):
-      find_mark(subject)
-    case TLet(loc2, tyof, var, rhs, body):
-      find_mark(rhs)
-      find_mark(body)
-    case Hole(loc2, tyof):
-      pass
-    case ArrayGet(loc2, tyof, arr, ind):
-      find_mark(arr)
-      find_mark(ind)
-    case _:
-      error(formula.location, 'in find_mark function, unhandled ' + str(formula))
-
-def replace_mark(formula, replacement):
-  match formula:
-    case Mark(loc2, tyof, subject):
-      return replacement
-    case TermInst(loc2, tyof, subject, tyargs, inferred):
-      return TermInst(loc2, tyof, replace_mark(subject, replacement), tyargs, inferred)
-    case Var(loc2, tyof, name):
-      return formula
-    case Bool(loc2, tyof, val):
-      return formula
-    case And(loc2, tyof, args):
-      return And(loc2, tyof, [replace_mark(arg, replacement) for arg in args])
-    case Or(loc2, tyof, args):
-      return Or(loc2, tyof, [replace_mark(arg, replacement) for arg in args])
-    case IfThen(loc2, tyof, prem, conc):
-      return IfThen(loc2, tyof, replace_mark(prem, replacement),
-                    replace_mark(conc, replacement))
-    case All(loc2, tyof, var, pos, frm2):
-      return All(loc2, tyof, var, pos, replace_mark(frm2, replacement))
-    case Some(loc2, tyof, vars, frm2):
-      return Some(loc2, tyof, vars, replace_mark(frm2, replacement))
-    case Call(loc2, tyof, rator, args):
-      return Call(loc2, tyof, replace_mark(rator, replacement),
-                  [replace_mark(arg, replacement) for arg in args])
-    case Switch(loc2, tyof, subject, cases):
-      return Switch(loc2, tyof, replace_mark(subject, replacement),
-                    [replace_mark(c, replacement) for c in cases])
-    case SwitchCase(loc2, pat, body):
-      return SwitchCase(loc2, pat, replace_mark(body, replacement))
-    case RecFun(loc, name, typarams, params, returns, cases):
-      return formula
-    case Conditional(loc2, tyof, cond, thn, els):
-      return Conditional(loc2, tyof, replace_mark(cond, replacement),
-                         replace_mark(thn, replacement),
-                         replace_mark(els, replacement))
-    case Lambda(loc2, tyof, vars, body):
-      return Lambda(loc2, tyof, vars, replace_mark(body, replacement))
-    case Generic(loc2, tyof, typarams, body):
-      return Generic(loc2, tyof, typarams, replace_mark(body, replacement))
-    case TAnnote(loc2, tyof, subject, typ):
-      return TAnnote(loc2, tyof, replace_mark(subject, replacement))
-    case TLet(loc2, tyof, var, rhs, body):
-      return TLet(loc2, tyof, var, replace_mark(rhs, replacement),
-                  replace_mark(body, replacement))
-    case Hole(loc2, tyof):
-      return formula
-    case ArrayGet(loc2, tyof, arr, ind):
-      return ArrayGet(loc2, tyof, replace_mark(arr, replacement), replace_mark(ind, replacement))
-    case _:
-      error(formula.location, 'in replace_mark function, unhandled ' + str(formula))
+def locate_mark(formula):
+  """Find the marks of a formula in a single traversal."""
+  ctx = MarkContext()
+  path = []
+  def visit(frm):
+    if isinstance(frm, Mark):
+      ctx.num_marks += 1
+      if ctx.num_marks == 1:
+        ctx.subject = frm.subject
+        ctx.path = list(path)
+    for (i, child) in enumerate(children(frm)):
+      path.append((frm, i))
+      visit(child)
+      path.pop()
+  visit(formula)
+  return ctx
 
 def remove_mark(formula):
-  num_marks = count_marks(formula)
-  if num_marks == 0:
+  ctx = locate_mark(formula)
+  if ctx.num_marks == 0:
       return formula
   else:
-        try:
-            find_mark(formula)
-            loc = formula.location if hasattr(formula, 'location') else None
-            error(loc, 'in remove_mark, find_mark failed on formula:\n\t' + str(formula))
-        except MarkException as ex:
-            return replace_mark(formula, ex.subject)
+      return ctx.plug(ctx.subject)
       
 def extract_and(frm):
     match frm:
@@ -4685,8 +5021,24 @@ def extract_or(frm):
       case _:
        return [frm]
 
+def count_reduce_calls():
+  """Wrap the reduce method of every AST class so that --stats counts
+  the calls to reduce by node type."""
+  def wrap(cls, reduce):
+    name = cls.__name__
+    def counted_reduce(self, env):
+      count('reduce', name)
+      return reduce(self, env)
+    return counted_reduce
+  todo = [AST]
+  while len(todo) > 0:
+    cls = todo.pop()
+    todo += cls.__subclasses__()
+    if 'reduce' in cls.__dict__:
+      cls.reduce = wrap(cls, cls.__dict__['reduce'])
+
 def uniquify_deduce(ast):
-  env = {}
+  env = ScopedDict()
   env['≠'] = ['≠']
   env['='] = ['=']
   # Using a space in the name to not collide with deduce identifiers
@@ -4739,16 +5091,37 @@ def reset_num_rewrites():
 def inc_rewrites():
     global num_rewrites
     num_rewrites = 1 + num_rewrites
+    work['rewrites'] += 1
 
 def get_num_rewrites():
     global num_rewrites
     return num_rewrites
 
+class RewriteRule:
+  """An equation prepared for rewriting. The sides of the equation,
+  its variables, and the arity of its left-hand side are computed
+  once instead of at every subterm that is visited."""
+
+  def __init__(self, loc, equation, env):
+    self.equation = equation
+    (self.lhs, self.rhs) = split_equation(loc, equation, env)
+    self.vars = equation_vars(equation)
+    self.arity = call_arity(self.lhs)
+
+  def __str__(self):
+    return str(self.equation)
+
+def compile_rewrite(loc, equation, env):
+  if isinstance(equation, RewriteRule):
+    return equation
+  return RewriteRule(loc, equation, env)
+
 def rewrite_aux(loc, formula, equation, env, depth = -1):
   if depth == 0:
       return formula
+  rule = compile_rewrite(loc, equation, env)
   try:
-    rhs = try_rewrite(loc, formula, equation, env)
+    rhs = try_rewrite(loc, formula, rule, env)
     inc_rewrites()
     return rhs
   except MatchFailed as e:
@@ -4756,40 +5129,20 @@ def rewrite_aux(loc, formula, equation, env, depth = -1):
       print('\tno match')
     pass
   match formula:
-    case TermInst(loc2, tyof, subject, tyargs, inferred):
-      return TermInst(loc2, tyof, rewrite_aux(loc, subject, equation, env, depth - 1),
-                      tyargs, inferred)
-    case Var(loc2, tyof, name, resolved_names):
-      return formula
-    case Bool(loc2, tyof, val):
-      return formula
-    case And(loc2, tyof, args):
-      return And(loc2, tyof, [rewrite_aux(loc, arg, equation, env, depth - 1) for arg in args])
-    case Or(loc2, tyof, args):
-      return Or(loc2, tyof, [rewrite_aux(loc, arg, equation, env, depth - 1) for arg in args])
-    case IfThen(loc2, tyof, prem, conc):
-      return IfThen(loc2, tyof, rewrite_aux(loc, prem, equation, env, depth - 1),
-                    rewrite_aux(loc, conc, equation, env, depth - 1))
-    case All(loc2, tyof, var, pos, frm2):
-      return All(loc2, tyof, var, pos, rewrite_aux(loc, frm2, equation, env, depth - 1))
-    case Some(loc2, tyof, vars, frm2):
-      return Some(loc2, tyof, vars, rewrite_aux(loc, frm2, equation, env, depth - 1))
     case Call(loc2, tyof, rator, args):
       is_assoc = is_associative(loc2, rator_name(rator), formula.typeof, env)
       if get_verbose():
           print('is_assoc? ' + str(is_assoc))
       if is_assoc:
-          # args = sum([flatten_assoc(rator_name(rator), arg) for arg in args], [])
           args = flatten_assoc_list(rator_name(rator), args)
-      new_rator = rewrite_aux(loc, rator, equation, env, depth - 1)
-      new_args = [rewrite_aux(loc, arg, equation, env, depth - 1) for arg in args]
+      new_rator = rewrite_aux(loc, rator, rule, env, depth - 1)
+      new_args = [rewrite_aux(loc, arg, rule, env, depth - 1) for arg in args]
       if False and get_verbose():
-          print('while trying to rewrite ' + str(formula) + '\n\twith equation ' + str(equation))
+          print('while trying to rewrite ' + str(formula) + '\n\twith equation ' + str(rule))
           print('new_args: ' + ', '.join([str(arg) for arg in new_args]))
-      (lhs,rhs) = split_equation(loc2, equation, env)
-      arity = call_arity(lhs)
+      arity = rule.arity
       if get_verbose():
-          print('lhs = ' + str(lhs) + '\n\tarity: ' + str(arity)) 
+          print('lhs = ' + str(rule.lhs) + '\n\tarity: ' + str(arity)) 
       if is_assoc and len(new_args) > arity and arity > 1:
         # try to rewrite each arity-number of adjacent terms
         i = 0
@@ -4799,13 +5152,13 @@ def rewrite_aux(loc, formula, equation, env, depth = -1):
             tmp = Call(loc2, tyof, new_rator, call_args)
             old_num_rewrites = get_num_rewrites()
             try:
-               new_tmp = rewrite_aux(loc, tmp, equation, env, depth)
+               new_tmp = rewrite_aux(loc, tmp, rule, env, depth)
             except MatchFailed as e:
                new_tmp = tmp
             new_num_rewrites = get_num_rewrites()
             if new_num_rewrites == old_num_rewrites:
                 if get_verbose():
-                    print('replace using: ' + str(equation) \
+                    print('replace using: ' + str(rule) \
                           + '\n\tdid not match: ' + str(tmp))
                 output_terms.append(new_args[i])
                 i = i + 1
@@ -4827,144 +5180,122 @@ def rewrite_aux(loc, formula, equation, env, depth = -1):
         if hasattr(formula, 'type_args'):
           call.type_args = formula.type_args
         return call
-  
-    case Switch(loc2, tyof, subject, cases):
-      return Switch(loc2, tyof, rewrite_aux(loc, subject, equation, env, depth - 1),
-                    [rewrite_aux(loc, c, equation, env, depth - 1) for c in cases])
-    case SwitchCase(loc2, pat, body):
-      return SwitchCase(loc2, pat, rewrite_aux(loc, body, equation, env, depth - 1))
-    case RecFun(loc, name, typarams, params, returns, cases):
-      return formula
-    case Conditional(loc2, tyof, cond, thn, els):
-      return Conditional(loc2, tyof, rewrite_aux(loc, cond, equation, env, depth - 1),
-                         rewrite_aux(loc, thn, equation, env, depth - 1),
-                         rewrite_aux(loc, els, equation, env, depth - 1))
-    case Lambda(loc2, tyof, vars, body):
-      return Lambda(loc2, tyof, vars, rewrite_aux(loc, body, equation, env, depth - 1))
-  
-    case Generic(loc2, tyof, typarams, body):
-      return Generic(loc2, tyof, typarams, rewrite_aux(loc, body, equation, env, depth - 1))
-  
-    case TAnnote(loc2, tyof, subject, typ):
-      return TAnnote(loc, tyof, rewrite_aux(loc, subject, equation, env, depth - 1), typ)
 
-    case ArrayGet(loc2, tyof, arr, ind):
-      return ArrayGet(loc, tyof, rewrite_aux(loc, arr, equation, env, depth - 1),
-                      rewrite_aux(loc, ind, equation, env, depth - 1))
-  
-    case TLet(loc2, tyof, var, rhs, body):
-      return TLet(loc2, tyof, var, rewrite_aux(loc, rhs, equation, env, depth - 1),
-                  rewrite_aux(loc, body, equation, env, depth - 1))
-  
-    case Hole(loc2, tyof):
-      return formula
-
-    case Omitted(loc2, tyof):
-      return formula
-  
-    case Mark(loc, tyof, subject):
-      return Mark(loc, tyof, rewrite_aux(loc, subject, equation, env, depth - 1))
-  
-    case _:
+    case _ if type(formula).child_slots is None:
       error(loc, 'internal error in rewrite function, unhandled ' + str(formula))
+    case _:
+      return map_children(formula,
+                          lambda t: rewrite_aux(loc, t, rule, env, depth - 1))
 
 def try_rewrite(loc, formula, equation, env):
-  (lhs, rhs) = split_equation(loc, equation, env)
+  rule = compile_rewrite(loc, equation, env)
+  (lhs, rhs) = (rule.lhs, rule.rhs)
   if False and get_verbose():
       print('try rewrite? ' + str(formula) + '\n\twith equation ' + str(equation))
   matching = {}
-  eq_vars = equation_vars(equation)
-  formula_match(loc, eq_vars, lhs, formula, matching, Env())
+  count('rewrite attempts', rule)
+  formula_match(loc, rule.vars, lhs, formula, matching, Env())
+  count('rewrite successes', rule)
   # print('rewriting using: ' + str(equation) + '\n' \
   #       + '\t' + str(formula) \
   #       + '\t==> ' + str(rhs.substitute(matching)) + '\n')
   if False and get_verbose():
       print('\tmatched LHS, rewriting to the RHS: ' + str(rhs.substitute(matching)))
-  return rhs.substitute(matching).reduce(env)
+  return cached_reduce(rhs.substitute(matching), env)
 
 def formula_match(loc, vars, pattern_frm, frm, matching, env):
+  """Match `pattern_frm` against `frm`, binding the variables in `vars`
+  in the dictionary `matching`. Raises MatchFailed if they do not match."""
   if False and get_verbose():
     print("formula_match:\n\t" + str(pattern_frm) + "\n\t" + str(frm) + "\n")
     print("\tin  " + ','.join([str(x) for x in vars]))
     print("\twith " + ','.join([x + ' := ' + str(f) for (x,f) in matching.items()]))
+  var_names = set(x.name for x in vars)
+  try:
+    formula_match_aux(loc, var_names, pattern_frm, frm, matching, [], env)
+  except MatchFailed:
+    count('formula_match', 'failures')
+    raise
+
+def undo_bindings(matching, trail, mark):
+  while len(trail) > mark:
+    del matching[trail.pop()]
+
+# The bound variables of the pattern are looked up in `matching` when
+# they are reached instead of being substituted into the rest of the
+# pattern, and `trail` records the order in which they were bound so
+# that a failed alternative can undo its bindings.
+def formula_match_aux(loc, vars, pattern_frm, frm, matching, trail, env):
   match (pattern_frm, frm):
     case (TermInst(loc1, tyof1, subject1, tyargs1, inferred1),
           TermInst(loc2, tyof2, subject2, tyargs2, inferred2)) \
           if len(tyargs1) == len(tyargs2):
+      mark = len(trail)
       try:
-        matching2 = dict(matching)
         for (t1,t2) in zip(tyargs1, tyargs2):
-          formula_match(loc, vars, t1, t2, matching2, env)
-        formula_match(loc, vars, subject1, subject2, matching2, env)
-        matching.clear()
-        matching.update(matching2)
+          formula_match_aux(loc, vars, t1, t2, matching, trail, env)
+        formula_match_aux(loc, vars, subject1, subject2, matching, trail, env)
       except MatchFailed as ex:
-        formula_match(loc, vars, subject1, frm, matching, env)
+        undo_bindings(matching, trail, mark)
+        formula_match_aux(loc, vars, subject1, frm, matching, trail, env)
         
     case (TermInst(loc2, tyof, subject, tyargs, inferred), _):
-      formula_match(loc, vars, subject, frm, matching, env)
+      formula_match_aux(loc, vars, subject, frm, matching, trail, env)
       
     case (_, TermInst(loc2, tyof, subject, tyargs, inferred)):
-      formula_match(loc, vars, pattern_frm, subject, matching, env)
+      formula_match_aux(loc, vars, pattern_frm, subject, matching, trail, env)
       
+    case (Var(l1, t1, name, rs1), _) if name in vars and name in matching.keys():
+      # The value of a pattern variable has no pattern variables in it.
+      formula_match_aux(loc, [], matching[name], frm, matching, trail, env)
+    case (Var(l1, t1, name, rs1), _) if name in vars:
+      if get_verbose():
+          print("formula_match, " + base_name(name) + ' := ' + str(frm))
+      matching[name] = frm
+      trail.append(name)
     case (Var(l1, t1, n1, rs1), Var(l2, t2, n2, rs2)) if n1 == n2:
       pass
-    case (Var(l1, t1, name, rs1), _) if pattern_frm in vars:
-      if name in matching.keys():
-        formula_match(loc, vars, matching[name], frm, matching, env)
-      else:
-        if get_verbose():
-            print("formula_match, " + base_name(name) + ' := ' + str(frm))
-        matching[name] = frm
         
     case (Call(loc2, tyof2, goal_rator, goal_rands),
           Call(loc3, tyof3, rator, rands)):
-      if False and get_verbose():
-          print("matching Call with Call\n\trator pattern: " + str(goal_rator) + '\n'\
-                + '\trator formula: ' + str(rator))
-      formula_match(loc, vars, goal_rator, rator, matching, env)
+      formula_match_aux(loc, vars, goal_rator, rator, matching, trail, env)
       if len(rands) >= len(goal_rands):
-        while len(rands) > 0:
-          # What is the following for? -Jeremy
-          if len(goal_rands) == 1 and len(rands) > 1:
-              rand = Call(loc3, tyof3, rator, rands)
-              rands = []
+        last = len(goal_rands) - 1
+        for (i, goal_rand) in enumerate(goal_rands):
+          # When there are more arguments than in the pattern,
+          # the last pattern argument matches the rest of them.
+          if i == last and len(rands) > len(goal_rands):
+              rand = Call(loc3, tyof3, rator, rands[i:])
           else:
-              rand = rands[0]
-              rands = rands[1:]
-              
-          goal_rand = goal_rands[0]
-          goal_rands = goal_rands[1:]
-            
-          new_goal_rand = goal_rand.substitute(matching)
-          formula_match(loc, vars, new_goal_rand, rand, matching, env)
-          
+              rand = rands[i]
+          formula_match_aux(loc, vars, goal_rand, rand, matching, trail, env)
       else:
-        match_failed(loc, "formula: " + str(frm) + "\n" \
-                     + "does not match expected formula: " + str(pattern_frm))
+        bindings = dict(matching)
+        lazy_match_failed(loc, lambda: "formula: " + str(frm) + "\n" \
+                          + "does not match expected formula: " \
+                          + str(pattern_frm.substitute(bindings)))
         
     case (And(loc2, tyof2, goal_args),
           And(loc3, tyof3, args)):
       for (goal_arg, arg) in zip(goal_args, args):
-          new_goal_arg = goal_arg.substitute(matching)
-          formula_match(loc, vars, new_goal_arg, arg, matching, env)
+          formula_match_aux(loc, vars, goal_arg, arg, matching, trail, env)
     case (Or(loc2, tyof2, goal_args),
           Or(loc3, tyof3, args)):
       for (goal_arg, arg) in zip(goal_args, args):
-          new_goal_arg = goal_arg.substitute(matching)
-          formula_match(loc, vars, new_goal_arg, arg, matching, env)
+          formula_match_aux(loc, vars, goal_arg, arg, matching, trail, env)
     case (IfThen(loc2, tyof2, goal_prem, goal_conc),
           IfThen(loc3, tyof3, prem, conc)):
-      formula_match(loc, vars, goal_prem, prem, matching, env)
-      new_goal_conc = goal_conc.substitute(matching)
-      formula_match(loc, vars, new_goal_conc, conc, matching, env)
+      formula_match_aux(loc, vars, goal_prem, prem, matching, trail, env)
+      formula_match_aux(loc, vars, goal_conc, conc, matching, trail, env)
     # UNDER CONSTRUCTION
     case _:
+      if len(matching) > 0:
+        pattern_frm = pattern_frm.substitute(matching)
       red_pattern = pattern_frm.reduce(env)
       red_frm = frm.reduce(env)
       if red_pattern != red_frm:
-          match_failed(loc, "formula: " + str(red_frm) + "\n" \
-                       + "does not match expected formula: " + str(red_pattern))
+          lazy_match_failed(loc, lambda: "formula: " + str(red_frm) + "\n" \
+                            + "does not match expected formula: " + str(red_pattern))
 
 def call_arity(call):
     match call:
@@ -4984,9 +5315,18 @@ def auto_rewrites(term, env):
     orig_term = term
     # Iterate until we can't rewrite anymore (to a fixed point)
     while True:
+        count('auto_rewrites', 'iterations')
         current = get_num_rewrites()
-        # Grab all the equations that are applicable to the head constructor
-        equations = env.get_auto_rewrites(term_head(term))
+        # Rewriting only happens at the root, and at adjacent arguments
+        # of an associative root.
+        if isinstance(term, Call):
+          assoc = is_associative(term.location, rator_name(term.rator),
+                                 term.typeof, env)
+        else:
+          assoc = False
+        # Grab the equations for the head constructor whose left-hand
+        # side could match.
+        equations = env.get_auto_rewrite_candidates(term, term_head(term), assoc)
         # Rewrite using the first equation that matches 
         for eq in equations:
             current_eq = get_num_rewrites()
@@ -4995,4 +5335,106 @@ def auto_rewrites(term, env):
                break
         if current == get_num_rewrites():
             break
-    return term        
+    return term
+
+class DiscriminationTree:
+  """An index of rewrite rules by the shape of their left-hand sides.
+
+  A left-hand side is stored as the preorder sequence of its symbols,
+  with '*' for the equation's variables and for any subterm that
+  `formula_match` might match by reduction instead of by structure,
+  such as a defined constant or a call below the root.
+  Retrieval walks a term against the tree and returns the rules that
+  might match it, in insertion order.
+  A call pattern with n arguments also matches a call with more
+  arguments, the extra ones being grouped into the last argument, as
+  in `formula_match`. With no arguments, it matches any call to the
+  same function."""
+
+  def __init__(self):
+    self.root = {}
+    self.rules = []
+
+  def insert(self, rule, env):
+    node = self.root
+    todo = [(rule.lhs, True)]
+    while len(todo) > 0:
+      (pattern, at_root) = todo.pop()
+      (sym, children) = self.pattern_symbol(pattern, rule.vars, env, at_root)
+      node = node.setdefault(sym, {})
+      todo += [(child, False) for child in reversed(children)]
+    node.setdefault(None, []).append(len(self.rules))
+    self.rules.append(rule)
+
+  def retrieve(self, term):
+    found = []
+    self.retrieve_aux(self.root, [term], found)
+    return [self.rules[i] for i in sorted(found)]
+
+  def retrieve_aux(self, node, todo, found):
+    if len(todo) == 0:
+      found += node.get(None, [])
+      return
+    term = strip_term_inst(todo[-1])
+    rest = todo[:-1]
+    if '*' in node:
+      self.retrieve_aux(node['*'], rest, found)
+    match term:
+      case Var(loc, tyof, name, rs):
+        if ('var', name) in node:
+          self.retrieve_aux(node[('var', name)], rest, found)
+      case RecFun(loc, name, typarams, params, returns, cases):
+        if ('var', name) in node:
+          self.retrieve_aux(node[('var', name)], rest, found)
+      case GenRecFun(loc, name, typarams, params, returns, measure, measure_ty, body, terminates):
+        if ('var', name) in node:
+          self.retrieve_aux(node[('var', name)], rest, found)
+      case Call(loc, tyof, rator, args):
+        for sym in node.keys():
+          if not (isinstance(sym, tuple) and sym[0] == 'call'):
+            continue
+          arity = sym[1]
+          if len(args) == arity:
+            children = args
+          elif arity == 0:
+            children = []
+          elif len(args) > arity:
+            children = args[:arity-1] + [Call(loc, tyof, rator, args[arity-1:])]
+          else:
+            continue
+          self.retrieve_aux(node[sym], rest + list(reversed(children)) + [rator],
+                            found)
+      case _:
+        pass
+
+  @staticmethod
+  def pattern_symbol(pattern, vars, env, at_root):
+    pattern = strip_term_inst(pattern)
+    match pattern:
+      case Var(loc, tyof, name, rs):
+        if pattern in vars or is_defined_constant(pattern, env):
+          return ('*', [])
+        return (('var', name), [])
+      # The term at the root is a call to the function of the rules in
+      # this tree, which is only matched by structure. Below the root,
+      # formula_match may reduce a call to match a term of another shape.
+      case Call(loc, tyof, rator, args) if at_root:
+        rator = strip_term_inst(rator)
+        if isinstance(rator, Var) and rator not in vars \
+           and not is_defined_constant(rator, env):
+          return (('call', len(args)), [rator] + args)
+        return ('*', [])
+      case _:
+        return ('*', [])
+
+def is_defined_constant(var, env):
+  """Whether the variable is defined as a term other than a recursive
+  function or a union, so that it may reduce to a different term."""
+  value = env.get_value_of_term_var(var)
+  return value is not None \
+    and not isinstance(value, (RecFun, GenRecFun, Union))
+
+def strip_term_inst(term):
+  while isinstance(term, TermInst):
+    term = term.subject
+  return term
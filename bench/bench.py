@@ -0,0 +1,202 @@
+"""Performance benchmarks for Deduce.
+
+Runs a fixed corpus of Deduce files, each in a fresh fork of this
+process, and reports the median and 95th percentile wall time, the peak
+memory, and the engine counters (see --stats) of each case.
+
+    python bench/bench.py [-n N] [--filter TEXT] [--output FILE]
+                          [--baseline FILE] [--time-threshold R]
+                          [--memory-threshold R] [--counter-threshold R]
+
+The corpus is every lib/*.pf, the files of test/should-validate listed
+in `selected_tests`, and every bench/stress/*.pf. Imported modules are
+not proof-checked, so each case measures the checking of one file.
+
+With --baseline, the results are compared against an earlier --output
+file, and the script exits with 1 if a case got slower (median time),
+used more memory, or did more work (total of the counters) than the
+baseline by more than the given ratio.
+"""
+import json
+import os
+import platform
+import sys
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+bench_dir = Path(__file__).resolve().parent
+deduce_dir = bench_dir.parent
+sys.path.insert(0, str(deduce_dir))
+
+import deduce
+from flags import set_check_imports, set_stats, add_import_directory, init_import_directories
+from abstract_syntax import count_reduce_calls
+from counters import get_counters
+
+lib_dir = deduce_dir / 'lib'
+pass_dir = deduce_dir / 'test' / 'should-validate'
+test_imports_dir = deduce_dir / 'test' / 'test-imports'
+stress_dir = bench_dir / 'stress'
+
+selected_tests = ['fib.pf', 'int1.pf', 'ListTests.pf', 'int_arith.pf',
+                  'nat_arith.pf', 'list2.pf', 'UIntLogTests.pf']
+
+def corpus():
+    cases = sorted(lib_dir.glob('*.pf'))
+    cases += [pass_dir / t for t in selected_tests if (pass_dir / t).exists()]
+    cases += sorted(stress_dir.glob('*.pf'))
+    return cases
+
+def case_name(path):
+    return str(path.relative_to(deduce_dir))
+
+def check_file(path, instrument):
+    """Check one file in this process and return its measurements."""
+    init_import_directories()
+    for d in [lib_dir, test_imports_dir, path.parent]:
+        add_import_directory(str(d))
+    set_check_imports(False)
+    deduce.suppress_theorems = True
+    sys.argv[0] = str(deduce_dir / 'deduce.py')
+    sys.setrecursionlimit(10000)
+    if instrument:
+        set_stats(True)
+        count_reduce_calls()
+        tracemalloc.start()
+    start = perf_counter()
+    deduce.deduce_file(str(path), False, [])
+    result = {'time': perf_counter() - start}
+    if instrument:
+        result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result['counters'] = {category: sum(c.values())
+                              for (category, c) in get_counters().items()}
+    return result
+
+def run_forked(path, instrument):
+    """Check one file in a child process, so that every run starts from
+    the same state, and return its measurements (None if it failed)."""
+    sys.stdout.flush()
+    (read_end, write_end) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        try:
+            result = check_file(path, instrument)
+            with os.fdopen(write_end, 'w') as out:
+                json.dump(result, out)
+            os._exit(0)
+        except BaseException:
+            os._exit(1)
+    os.close(write_end)
+    with os.fdopen(read_end) as inp:
+        data = inp.read()
+    (_, status) = os.waitpid(pid, 0)
+    if status != 0 or data == '':
+        return None
+    return json.loads(data)
+
+def percentile(values, p):
+    values = sorted(values)
+    i = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[i]
+
+def bench_case(path, repetitions):
+    times = []
+    for i in range(repetitions):
+        result = run_forked(path, False)
+        if result is None:
+            return {'failed': True}
+        times.append(result['time'])
+    instrumented = run_forked(path, True)
+    if instrumented is None:
+        return {'failed': True}
+    return {'median': percentile(times, 50), 'p95': percentile(times, 95),
+            'times': times, 'peak_memory': instrumented['peak_memory'],
+            'counters': instrumented['counters']}
+
+def compare(results, baseline, thresholds):
+    """The regressions of `results` with respect to `baseline`."""
+    regressions = []
+    for (name, case) in results['cases'].items():
+        old = baseline['cases'].get(name)
+        if old is None or case.get('failed') or old.get('failed'):
+            continue
+        measures = [('median time', case['median'], old['median'], thresholds['time']),
+                    ('peak memory', case['peak_memory'], old['peak_memory'],
+                     thresholds['memory']),
+                    ('counters', sum(case['counters'].values()),
+                     sum(old['counters'].values()), thresholds['counters'])]
+        for (what, new_value, old_value, threshold) in measures:
+            if old_value > 0 and new_value > old_value * (1 + threshold):
+                regressions.append(f'{name}: {what} {old_value:.4g} -> {new_value:.4g}'
+                                   f' (+{(new_value / old_value - 1) * 100:.1f}%)')
+    return regressions
+
+def main(argv):
+    repetitions = 5
+    name_filter = None
+    output = None
+    baseline_file = None
+    thresholds = {'time': 0.10, 'memory': 0.10, 'counters': 0.0}
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '-n' and i + 1 < len(argv):
+            repetitions = int(argv[i + 1]); i += 1
+        elif arg == '--filter' and i + 1 < len(argv):
+            name_filter = argv[i + 1]; i += 1
+        elif arg == '--output' and i + 1 < len(argv):
+            output = argv[i + 1]; i += 1
+        elif arg == '--baseline' and i + 1 < len(argv):
+            baseline_file = argv[i + 1]; i += 1
+        elif arg == '--time-threshold' and i + 1 < len(argv):
+            thresholds['time'] = float(argv[i + 1]); i += 1
+        elif arg == '--memory-threshold' and i + 1 < len(argv):
+            thresholds['memory'] = float(argv[i + 1]); i += 1
+        elif arg == '--counter-threshold' and i + 1 < len(argv):
+            thresholds['counters'] = float(argv[i + 1]); i += 1
+        else:
+            print('unknown argument: ' + arg)
+            print(__doc__)
+            return 2
+        i += 1
+
+    results = {'python': platform.python_version(),
+               'machine': platform.machine(),
+               'repetitions': repetitions,
+               'cases': {}}
+    print(f'{"case":<45}{"median":>10}{"p95":>10}{"peak MB":>10}{"counters":>12}')
+    for path in corpus():
+        name = case_name(path)
+        if name_filter and name_filter not in name:
+            continue
+        case = bench_case(path, repetitions)
+        results['cases'][name] = case
+        if case.get('failed'):
+            print(f'{name:<45}{"failed":>10}')
+        else:
+            print(f'{name:<45}{case["median"]:10.3f}{case["p95"]:10.3f}'
+                  f'{case["peak_memory"] / 2**20:10.1f}{sum(case["counters"].values()):12}')
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline_file:
+        with open(baseline_file, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, thresholds)
+        if len(regressions) > 0:
+            print('\nregressions against ' + baseline_file + ':')
+            for r in regressions:
+                print('  ' + r)
+            return 1
+        print('\nno regressions against ' + baseline_file)
+    return 0
+
+if __name__ == '__main__':
+    exit(main(sys.argv))
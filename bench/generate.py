@@ -0,0 +1,155 @@
+"""Generate synthetic Deduce files for scaling studies.
+
+    python bench/generate.py KIND SIZE DIRECTORY
+    python bench/generate.py --corpus
+
+The first form writes the files of one workload into DIRECTORY and
+prints the name of the file to check. The second regenerates
+bench/stress, the workloads that bench/bench.py checks, at the sizes in
+`corpus_sizes`. The kinds of workload are:
+
+    theorems   SIZE theorems in one module
+    imports    a chain of SIZE modules, each importing the previous one
+    union      a union with SIZE constructors, a function over it, and
+               a proof by cases
+    numerals   asserts about unsigned integers around SIZE
+    lists      asserts about a list of length SIZE
+    haves      a proof with SIZE `have` steps
+    replaces   a chain of SIZE equations, used by `equations` steps and
+               by one long `replace`
+
+Size 0 writes a file with only the imports of the workload, whose time
+is the cost that does not depend on the size.
+"""
+import os
+import sys
+from pathlib import Path
+
+def theorems(n):
+    lines = ['import UInt', '']
+    for i in range(n):
+        lines += [f'theorem thm{i}: all x:UInt. x + {i} = {i} + x',
+                  'proof',
+                  '  arbitrary x:UInt',
+                  f'  uint_add_commute[x, {i}]',
+                  'end', '']
+    return {f'Theorems{n}.pf': '\n'.join(lines)}
+
+def imports(d):
+    files = {}
+    for k in range(d):
+        lines = ['public import UInt'] if k == 0 else [f'public import Chain{d}_{k-1}']
+        lines += ['',
+                  f'fun f{k}(x : UInt) {{ ' + ('x + 1' if k == 0 else f'f{k-1}(x) + 1') + ' }',
+                  '',
+                  f'theorem f{k}_zero: f{k}(0) = {k + 1}',
+                  'proof',
+                  f'  expand ' + ' | '.join(f'f{j}' for j in range(k, -1, -1)) + '.',
+                  'end', '']
+        files[f'Chain{d}_{k}.pf'] = '\n'.join(lines)
+    return files
+
+def union(k):
+    cons = [f'c{i}' for i in range(k)]
+    lines = [f'union Color{k} {{'] + [f'  {c}' for c in cons] + ['}', '']
+    lines += [f'fun next{k}(c : Color{k}) {{', '  switch c {']
+    lines += [f'    case {c} {{ {cons[(i + 1) % k]} }}' for (i, c) in enumerate(cons)]
+    lines += ['  }', '}', '']
+    lines += [f'theorem next{k}_total: all c:Color{k}. some d:Color{k}. next{k}(c) = d',
+              'proof',
+              f'  arbitrary c:Color{k}',
+              '  switch c {']
+    for (i, c) in enumerate(cons):
+        lines += [f'    case {c} {{',
+                  f'      choose {cons[(i + 1) % k]}',
+                  f'      expand next{k}.',
+                  '    }']
+    lines += ['  }', 'end', '']
+    return {f'Union{k}.pf': '\n'.join(lines)}
+
+def numerals(m):
+    lines = ['import UInt', '',
+             f'assert {m} + {m} = {2 * m}',
+             f'assert {m} * 2 = {2 * m}',
+             f'assert {m} ≤ {m + 1}',
+             f'assert {m + 1} ∸ 1 = {m}', '']
+    return {f'Numerals{m}.pf': '\n'.join(lines)}
+
+def lists(n):
+    elems = ', '.join(str(i % 10) for i in range(n))
+    lines = ['import UInt', 'import List', '',
+             f'define xs{n} : List<UInt> = [{elems}]', '',
+             f'assert length(xs{n}) = {n}',
+             f'assert length(xs{n} ++ xs{n}) = {2 * n}',
+             f'assert reverse(reverse(xs{n})) = xs{n}', '']
+    return {f'Lists{n}.pf': '\n'.join(lines)}
+
+def haves(n):
+    lines = ['import UInt', '',
+             f'theorem haves{n}: all x:UInt. x + 0 = x',
+             'proof',
+             '  arbitrary x:UInt',
+             '  have h0: x + 0 = x by uint_add_zero[x]']
+    for i in range(1, n):
+        lines.append(f'  have h{i}: x + 0 = x by h{i-1}')
+    lines += [f'  conclude x + 0 = x by h{n-1}', 'end', '']
+    return {f'Haves{n}.pf': '\n'.join(lines)}
+
+def replaces(n):
+    xs = [f'x{i}' for i in range(n + 1)]
+    eqs = [f'{xs[i]} = {xs[i+1]}' for i in range(n)]
+    lines = ['import Nat', '',
+             f'theorem replaces{n}: all ' + ', '.join(x + ':Nat' for x in xs) + '.',
+             '  ' + ' then '.join('if ' + e for e in eqs) + f' then x0 = x{n}',
+             'proof',
+             '  arbitrary ' + ', '.join(x + ':Nat' for x in xs)]
+    lines += [f'  suppose e{i}: {e}' for (i, e) in enumerate(eqs)]
+    lines += [f'  have chain: x0 = x{n} by',
+              '    equations',
+              f'      x0 = x1 by replace e0.']
+    lines += [f'     ... = x{i+1} by replace e{i}.' for i in range(1, n)]
+    lines += [f'  conclude x0 = x{n} by replace ' + ' | '.join(f'e{i}' for i in range(n)) + '.',
+              'end', '']
+    return {f'Replaces{n}.pf': '\n'.join(lines)}
+
+kinds = {'theorems': theorems, 'imports': imports, 'union': union,
+         'numerals': numerals, 'lists': lists, 'haves': haves,
+         'replaces': replaces}
+
+def baseline(kind):
+    """A file with the imports of a workload and nothing else."""
+    text = list(kinds[kind](1).values())[-1]
+    lines = [l for l in text.splitlines()
+             if l.startswith('import ') or l.startswith('public import ')]
+    return {f'Baseline_{kind}.pf': '\n'.join(lines + [''])}
+
+def generate(kind, size, directory):
+    """Write the files of a workload to `directory` and return the path
+    of the file to check (the last one written)."""
+    os.makedirs(directory, exist_ok=True)
+    files = baseline(kind) if size == 0 else kinds[kind](size)
+    for (name, text) in files.items():
+        with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+            f.write(text)
+    return Path(directory) / list(files.keys())[-1]
+
+# The workloads of the benchmark corpus, at sizes that take a few
+# seconds each.
+corpus_sizes = {'theorems': 40, 'union': 40, 'numerals': 300,
+                'lists': 40, 'haves': 200, 'replaces': 40}
+
+def generate_corpus():
+    directory = Path(__file__).resolve().parent / 'stress'
+    for old in directory.glob('*.pf'):
+        old.unlink()
+    for (kind, size) in corpus_sizes.items():
+        print(generate(kind, size, directory))
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--corpus']:
+        generate_corpus()
+    elif len(sys.argv) == 4 and sys.argv[1] in kinds:
+        print(generate(sys.argv[1], int(sys.argv[2]), sys.argv[3]))
+    else:
+        print(__doc__)
+        exit(1)
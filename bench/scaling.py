@@ -0,0 +1,133 @@
+"""Measure how Deduce scales with the size of synthetic workloads.
+
+    python bench/scaling.py [-n N] [--output FILE] [--plot DIRECTORY]
+                            [KIND[=SIZE,SIZE,...] ...]
+
+For each kind of workload of bench/generate.py (all of them by default)
+and each size, generates the files into a temporary directory and
+checks them as bench/bench.py does. Prints the median time and the peak
+memory per size, with the growth exponent k of time ~ size^k between
+the smallest and the largest size, so that quadratic paths stand out.
+Each kind is also checked at size 0, with only its imports, and that
+time and memory are subtracted before fitting k, so that the loading of
+the standard library does not flatten the growth.
+
+--output writes the measurements as JSON. --plot writes one PNG per
+kind with time and memory against size; it needs matplotlib, which is
+otherwise not required.
+"""
+import json
+import math
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from bench import bench_case
+from generate import generate, kinds
+
+default_sizes = {'theorems': [10, 20, 40, 80],
+                 'imports': [2, 4, 8, 16],
+                 'union': [5, 10, 20, 40],
+                 'numerals': [10, 100, 1000, 10000],
+                 'lists': [10, 20, 40, 80],
+                 'haves': [25, 50, 100, 200],
+                 'replaces': [5, 10, 20, 40]}
+
+def growth(points):
+    """The exponent k such that y ~ x^k between the first and last point."""
+    ((x0, y0), (x1, y1)) = (points[0], points[-1])
+    if x0 <= 0 or y0 <= 0 or x1 == x0 or y1 <= 0:
+        return None
+    return math.log(y1 / y0) / math.log(x1 / x0)
+
+def measure(kind, sizes, repetitions):
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in [0] + [s for s in sizes if s != 0]:
+            path = generate(kind, size, directory)
+            case = bench_case(path, repetitions)
+            case['size'] = size
+            rows.append(case)
+            if case.get('failed'):
+                print(f'  {kind:<10}{size:>8}{"failed":>10}')
+            else:
+                print(f'  {kind:<10}{size:>8}{case["median"]:10.3f}'
+                      f'{case["peak_memory"] / 2**20:10.1f}')
+    return rows
+
+def plot(kind, rows, directory):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    rows = [r for r in rows if not r.get('failed')]
+    sizes = [r['size'] for r in rows]
+    (fig, (time_ax, mem_ax)) = plt.subplots(1, 2, figsize=(10, 4))
+    time_ax.plot(sizes, [r['median'] for r in rows], marker='o')
+    time_ax.set_xlabel(kind + ' size')
+    time_ax.set_ylabel('median time (s)')
+    mem_ax.plot(sizes, [r['peak_memory'] / 2**20 for r in rows], marker='o')
+    mem_ax.set_xlabel(kind + ' size')
+    mem_ax.set_ylabel('peak memory (MB)')
+    fig.tight_layout()
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    fig.savefig(Path(directory) / (kind + '.png'))
+    plt.close(fig)
+
+def main(argv):
+    repetitions = 3
+    output = None
+    plot_dir = None
+    selected = {}
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '-n' and i + 1 < len(argv):
+            repetitions = int(argv[i + 1]); i += 1
+        elif arg == '--output' and i + 1 < len(argv):
+            output = argv[i + 1]; i += 1
+        elif arg == '--plot' and i + 1 < len(argv):
+            plot_dir = argv[i + 1]; i += 1
+        elif arg.split('=')[0] in kinds:
+            (kind, _, sizes) = arg.partition('=')
+            selected[kind] = [int(s) for s in sizes.split(',')] if sizes \
+                else default_sizes[kind]
+        else:
+            print('unknown argument: ' + arg)
+            print(__doc__)
+            return 2
+        i += 1
+    if len(selected) == 0:
+        selected = default_sizes
+
+    if plot_dir:
+        try:
+            import matplotlib
+        except ImportError:
+            print('--plot needs matplotlib, which is not installed')
+            return 2
+
+    results = {}
+    print(f'  {"kind":<10}{"size":>8}{"median":>10}{"peak MB":>10}')
+    for (kind, sizes) in selected.items():
+        rows = measure(kind, sizes, repetitions)
+        results[kind] = rows
+        ok = [r for r in rows if not r.get('failed')]
+        if len(ok) >= 3 and ok[0]['size'] == 0:
+            (base, ok) = (ok[0], ok[1:])
+            k = growth([(r['size'], r['median'] - base['median']) for r in ok])
+            m = growth([(r['size'], r['peak_memory'] - base['peak_memory'])
+                        for r in ok])
+            print(f'  {kind}: time ~ size^{k:.2f}, memory ~ size^{m:.2f}'
+                  if k is not None and m is not None else f'  {kind}: no growth estimate')
+        if plot_dir:
+            plot(kind, rows, plot_dir)
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    exit(main(sys.argv))
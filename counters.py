@@ -0,0 +1,32 @@
+from flags import get_stats
+
+# counters[category][key] is the number of times `key` was counted in
+# `category`. Nothing is counted unless --stats is on.
+counters = {}
+
+def count(category, key):
+  if get_stats():
+    c = counters.setdefault(category, {})
+    c[key] = c.get(key, 0) + 1
+
+def get_counters():
+  return counters
+
+def reset_counters():
+  counters.clear()
+
+def stats_report(num_keys=10):
+  """The counters of each category, largest first. Keys that print the
+  same, such as two copies of one equation, are added together."""
+  lines = []
+  for (category, c) in counters.items():
+    totals = {}
+    for (key, n) in c.items():
+      totals[str(key)] = totals.get(str(key), 0) + n
+    lines.append(category + ': ' + str(sum(totals.values())))
+    ranked = sorted(totals.items(), key=lambda kv: kv[1], reverse=True)
+    for (key, n) in ranked[:num_keys]:
+      lines.append(f'  {n:10}  {key}')
+    if len(ranked) > num_keys:
+      lines.append(f'  {"":10}  ... and {len(ranked) - num_keys} more')
+  return '\n'.join(lines)
@@ -1,6 +1,8 @@
 from flags import *
-from proof_checker import check_deduce, uniquify_deduce, is_modified
-from abstract_syntax import init_import_directories, add_import_directory, print_theorems, get_recursive_descent, set_recursive_descent, get_uniquified_modules, add_uniquified_module, VerboseLevel
+from proof_checker import check_deduce, uniquify_deduce, is_modified, charge_proof_costs
+from abstract_syntax import init_import_directories, add_import_directory, print_theorems, get_recursive_descent, set_recursive_descent, get_uniquified_modules, add_uniquified_module, VerboseLevel, count_reduce_calls
+from profiler import profile_phase, profile_report, write_profile_json, write_heatmaps, traced, write_trace, memory_report
+from counters import stats_report
 from signal import signal, SIGINT
 import sys
 import os
@@ -9,6 +11,7 @@ import rec_desc_parser
 #from parser import parse, set_filename, get_filename, set_deduce_directory, init_parser
 #from rec_desc_parser import parse, set_filename, get_filename, set_deduce_directory, init_parser
 import traceback
+import tracemalloc
 from pathlib import Path
 
 traceback_flag = False
@@ -19,6 +22,10 @@ def handle_sigint(signal, stack_frame):
     exit(137)
 
 def deduce_file(filename, error_expected, tracing_functions):
+    with traced(Path(filename).stem, 'module', {'file': filename}):
+        check_file(filename, error_expected, tracing_functions)
+
+def check_file(filename, error_expected, tracing_functions):
     if get_verbose():
         print("Deducing file:", filename)
     module_name = Path(filename).stem
@@ -36,19 +43,22 @@ def deduce_file(filename, error_expected, tracing_functions):
                 rec_desc_parser.set_deduce_directory(os.path.dirname(sys.argv[0]))
                 rec_desc_parser.set_filename(filename)
                 rec_desc_parser.init_parser()
-                ast = rec_desc_parser.parse(program_text, trace=get_verbose(),
-                                            error_expected=error_expected)
+                with profile_phase(module_name, 'parse'):
+                    ast = rec_desc_parser.parse(program_text, trace=get_verbose(),
+                                                error_expected=error_expected)
             else:
                 parser.set_deduce_directory(os.path.dirname(sys.argv[0]))
                 parser.set_filename(filename)
                 parser.init_parser()
-                ast = parser.parse(program_text, trace=get_verbose(),
-                                   error_expected=error_expected)
+                with profile_phase(module_name, 'parse'):
+                    ast = parser.parse(program_text, trace=get_verbose(),
+                                       error_expected=error_expected)
             if get_verbose():
                 print("abstract syntax tree:\n" \
                       +'\n'.join([str(s) for s in ast])+"\n\n")
                 print("starting uniquify:\n" + '\n'.join([str(d) for d in ast]))
-            uniquify_deduce(ast)
+            with profile_phase(module_name, 'uniquify'):
+                uniquify_deduce(ast)
             if get_verbose():
                 print("finished uniquify:\n" + '\n'.join([str(d) for d in ast]))
             add_uniquified_module(module_name, ast)
@@ -98,6 +108,7 @@ if __name__ == "__main__":
     tracing_functions = []
     error_expected = False
     recursive_directories = False
+    profile_json_file = None
     already_processed_next = False
     init_import_directories()
 
@@ -147,6 +158,22 @@ if __name__ == "__main__":
             exit(0)
         elif argument == '--no-check-imports':
             set_check_imports(False)
+        elif argument == '--stats':
+            set_stats(True)
+        elif argument == '--profile':
+            set_profile(True)
+        elif argument == '--profile-json' and i + 1 < len(sys.argv):
+            set_profile(True)
+            profile_json_file = sys.argv[i+1]
+            already_processed_next = True
+        elif argument == '--trace-json' and i + 1 < len(sys.argv):
+            set_trace_file(sys.argv[i+1])
+            already_processed_next = True
+        elif argument == '--memory-profile':
+            set_memory_profile(True)
+        elif argument == '--heatmap' and i + 1 < len(sys.argv):
+            set_heatmap(sys.argv[i+1])
+            already_processed_next = True
         else:
             deducables.append(argument)
     
@@ -157,6 +184,13 @@ if __name__ == "__main__":
         print("Couldn't find a file to deduce!")
         exit(1)
 
+    if get_stats():
+        count_reduce_calls()
+    if get_heatmap() is not None or get_trace_file() is not None:
+        charge_proof_costs()
+    if get_memory_profile():
+        tracemalloc.start()
+
     sys.setrecursionlimit(10000)
     # We can probably use a loop for some tail recursive functions
     # And even the non-tail recursive functions can be turned into a
@@ -175,3 +209,17 @@ if __name__ == "__main__":
         else:
             print(deducable, "was not found!")
             exit(1)
+
+    if get_stats():
+        print(stats_report())
+
+    if get_profile():
+        print(profile_report())
+        if profile_json_file:
+            write_profile_json(profile_json_file)
+    if get_memory_profile():
+        print(memory_report())
+    if get_heatmap() is not None:
+        write_heatmaps(get_heatmap())
+    if get_trace_file() is not None:
+        write_trace(get_trace_file())
@@ -10,33 +10,93 @@ def score(x, y):
         return 0
     else:
         return 1
-      
-def edit_distance(s1, s2):
+
+# Every edit costs at most one, so the distance is at least the
+# difference in length, and cells more than `bound` away from the
+# diagonal can never come back under the bound.
+def edit_distance(s1, s2, bound=None):
     m = len(s1); n = len(s2)
-    F = {}
-    F[(0, 0)] = 0
-    for i in range(1, m+1):
-        F[(i, 0)] = space_penalty * i
-        
-    for j in range(1, n+1):
-        F[(0, j)] = space_penalty * j
-    
+    if bound is None:
+        bound = m + n
+    too_far = bound + 1
+    if abs(m - n) * space_penalty > bound:
+        return too_far
+
+    prev = [space_penalty * j if j <= bound else too_far for j in range(n+1)]
     for i in range(1, m+1):
-        for j in range(1, n+1):
-            match = F[(i-1, j-1)] + score(s1[i-1], s2[j-1])
-            delete = F[(i-1, j)] + space_penalty
-            insert = F[(i, j-1)] + space_penalty
-            F[(i, j)] = min(match, delete, insert)
-    return F[(m, n)]
+        cur = [too_far] * (n+1)
+        if i <= bound:
+            cur[0] = space_penalty * i
+        row_min = cur[0]
+        for j in range(max(1, i - bound), min(n, i + bound) + 1):
+            match = prev[j-1] + score(s1[i-1], s2[j-1])
+            delete = prev[j] + space_penalty
+            insert = cur[j-1] + space_penalty
+            d = min(match, delete, insert, too_far)
+            cur[j] = d
+            if d < row_min:
+                row_min = d
+        if row_min > bound:
+            return too_far
+        prev = cur
+    return prev[n]
 
-def closest_keyword(word, keywords):
-    best_yet = None
-    for kw in keywords:
-        d = edit_distance(word, kw)
-        if d <= ceil(len(word) / 6):
-            if best_yet == None or d < best_yet[1]:
-                best_yet = (kw, d)
-    if best_yet:
-        return best_yet[0]
+class SuggestionIndex:
+    """Candidate words bucketed by length, so a lookup only compares
+    against the words whose length is within the bound."""
+
+    def __init__(self, words=()):
+        self.buckets = {}
+        self.count = 0
+        for w in words:
+            self.add(w)
+
+    def add(self, word):
+        self.buckets.setdefault(len(word), []).append((self.count, word))
+        self.count += 1
+
+    def candidates(self, word, bound):
+        cands = []
+        for n in range(max(0, len(word) - bound), len(word) + bound + 1):
+            cands += self.buckets.get(n, [])
+        cands.sort()
+        return [w for (_, w) in cands]
+
+    def close_matches(self, word, bound):
+        """The words within `bound` of `word`, in the order they were added."""
+        return [w for w in self.candidates(word, bound)
+                if edit_distance(word, w, bound) <= bound]
+
+    def closest(self, word, bound):
+        best_yet = None
+        for w in self.candidates(word, bound):
+            d = edit_distance(word, w, bound)
+            if d <= bound:
+                if best_yet == None or d < best_yet[1]:
+                    best_yet = (w, d)
+        if best_yet:
+            return best_yet[0]
+        else:
+            return None
+
+# The indexes of the most recently used collections of words, such as
+# the keywords of the parser and the names in an environment.
+suggestion_indexes = {}
+max_suggestion_indexes = 16
+
+def suggestion_index(words):
+    key = tuple(words)
+    if key in suggestion_indexes:
+        index = suggestion_indexes.pop(key)
     else:
-        return None
+        index = SuggestionIndex(key)
+        if len(suggestion_indexes) >= max_suggestion_indexes:
+            del suggestion_indexes[next(iter(suggestion_indexes))]
+    suggestion_indexes[key] = index
+    return index
+
+def close_matches(word, words, bound):
+    return suggestion_index(words).close_matches(word, bound)
+
+def closest_keyword(word, keywords):
+    return suggestion_index(keywords).closest(word, ceil(len(word) / 6))
@@ -31,12 +31,35 @@ class StaticError(Exception):
 def static_error(location, msg):
   raise StaticError(error_header(location) + msg)
 
-class MatchFailed(Exception):
+class DeferredError(Exception):
+  """An error whose message may be given as a thunk that is only called
+  if the message is printed. Used for the failures of searches, such as
+  matching, proving implications, and resolving overloads, which are
+  usually caught and discarded."""
+  def __init__(self, msg='', thunk=None):
+    super().__init__(msg)
+    self.thunk = thunk
+
+  def __str__(self):
+    if self.thunk:
+      self.args = (self.thunk(),)
+      self.thunk = None
+    return super().__str__()
+
+def lazy_error(location, msg_thunk):
+  exc = DeferredError(thunk=lambda: error_header(location) + msg_thunk())
+  exc.depth = 0
+  raise exc
+
+class MatchFailed(DeferredError):
   pass
 
 def match_failed(location, msg):
   raise MatchFailed(error_header(location) + msg)
 
+def lazy_match_failed(location, msg_thunk):
+  raise MatchFailed(thunk=lambda: error_header(location) + msg_thunk())
+
 MAX_ERR_DEPTH = 2
 
 # Parse Errors need to carry around some extra data
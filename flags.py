@@ -120,3 +120,63 @@ def set_check_imports(b):
   global check_imports
   check_imports = b
   
+
+# flag for printing statistics about the checker's caches
+
+stats = False
+
+def get_stats():
+  global stats
+  return stats
+
+def set_stats(b):
+  global stats
+  stats = b
+
+# flag for recording the time spent in each phase of checking
+
+profile = False
+
+def get_profile():
+  global profile
+  return profile
+
+def set_profile(b):
+  global profile
+  profile = b
+
+# directory in which to write the proof-cost heat maps (None for no heat maps)
+
+heatmap = None
+
+def get_heatmap():
+  global heatmap
+  return heatmap
+
+def set_heatmap(d):
+  global heatmap
+  heatmap = d
+
+# file in which to write a Chrome trace of the run (None for no trace)
+
+trace_file = None
+
+def get_trace_file():
+  global trace_file
+  return trace_file
+
+def set_trace_file(f):
+  global trace_file
+  trace_file = f
+
+# flag for measuring the memory used in each phase of checking
+
+memory_profile = False
+
+def get_memory_profile():
+  global memory_profile
+  return memory_profile
+
+def set_memory_profile(b):
+  global memory_profile
+  memory_profile = b
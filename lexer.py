@@ -0,0 +1,86 @@
+import re
+from lark import Token
+from lark.load_grammar import load_grammar
+from lark.lexer import PatternStr
+from lark.tree import Meta
+from error import ParseError
+
+# A lexer for the recursive-descent parser. It takes the terminals of
+# Deduce.lark from Lark's grammar loader, without building a parser,
+# and matches them with one combined regular expression. The tokens are
+# the same as those of Lark's basic lexer: the same types, values, and
+# positions, with the same rules for which terminal wins.
+
+class Lexer:
+
+  def __init__(self, grammar_file):
+    with open(grammar_file, encoding='utf-8') as f:
+      (grammar, _) = load_grammar(f.read(), grammar_file, [], False)
+    (terminals, _, ignore) = grammar.compile(['program'], set())
+    # Lark tries the terminals in this order, taking the first match.
+    terminals.sort(key=lambda t: (-t.priority, -t.pattern.max_width,
+                                  -len(t.pattern.value), t.name))
+    # A string terminal that a regular expression terminal also matches,
+    # such as the keyword "all" and IDENT, is lexed by the regular
+    # expression and then given the type of the string.
+    self.retype = {}
+    folded = set()
+    strings = [t for t in terminals if isinstance(t.pattern, PatternStr)]
+    for t in terminals:
+      if isinstance(t.pattern, PatternStr):
+        continue
+      for s in strings:
+        if s.priority != t.priority:
+          continue
+        m = re.match(t.pattern.to_regexp(), s.pattern.value)
+        if m and m.group(0) == s.pattern.value:
+          self.retype.setdefault(t.name, {})[s.pattern.value] = s.name
+          if s.pattern.flags <= t.pattern.flags:
+            folded.add(s.name)
+    self.regex = re.compile('|'.join('(?P<' + t.name + '>' + t.pattern.to_regexp() + ')'
+                                     for t in terminals if t.name not in folded))
+    self.ignore = frozenset(ignore)
+
+  def lex(self, text, filename):
+    """The list of tokens in `text`, leaving out white space and comments."""
+    tokens = []
+    pos = 0
+    line = 1
+    line_start = 0    # the position where the current line starts
+    match = self.regex.match
+    while pos < len(text):
+      m = match(text, pos)
+      if m is None:
+        meta = Meta()
+        meta.empty = False
+        meta.filename = filename
+        meta.line = meta.end_line = line
+        meta.column = pos - line_start + 1
+        meta.end_column = meta.column + 1
+        meta.start_pos = pos
+        meta.end_pos = pos + 1
+        raise ParseError(meta, 'unexpected character "' + text[pos] + '"')
+      kind = m.lastgroup
+      value = m.group()
+      end = m.end()
+      newlines = value.count('\n')
+      if kind in self.ignore:
+        if newlines > 0:
+          line += newlines
+          line_start = pos + value.rindex('\n') + 1
+        pos = end
+        continue
+      names = self.retype.get(kind)
+      if names is not None:
+        kind = names.get(value, kind)
+      column = pos - line_start + 1
+      if newlines > 0:
+        end_line = line + newlines
+        line_start = pos + value.rindex('\n') + 1
+      else:
+        end_line = line
+      tokens.append(Token(kind, value, pos, line, column,
+                          end_line, end - line_start + 1, end))
+      line = end_line
+      pos = end
+    return tokens
@@ -35,10 +35,16 @@ def get_deduce_directory():
 ##################################################
 
 lark_parser = None
+lark_parser_file = None
 
+# The grammar is only compiled once per file, so that checking many
+# files in one process does not pay for it each time.
 def init_parser():
-  global lark_parser
+  global lark_parser, lark_parser_file
   lark_file = get_deduce_directory() + "/Deduce.lark"
+  if lark_parser is not None and lark_parser_file == lark_file:
+    return
+  lark_parser_file = lark_file
   lark_parser = Lark(open(lark_file, encoding="utf-8").read(),
                      start='program', parser='lalr',
                      debug=True, propagate_positions=True)
@@ -158,7 +164,7 @@ def set_visibility(statement, visibility):
 def build_equations_proof(loc, eqs):
     result = None
     for (lhs, rhs, reason) in reversed(eqs):
-        num_marks = count_marks(lhs) + count_marks(rhs)
+        num_marks = locate_mark(lhs).num_marks + locate_mark(rhs).num_marks
         if num_marks == 0 and get_default_mark_LHS():
             new_lhs = Mark(loc, None, lhs)
         else:
@@ -485,7 +491,7 @@ def parse_tree_to_ast(e, parent):
         type_args = parse_tree_to_list(e.children[1], e)
         result = univ
         for i, ty in enumerate(type_args):
-            result = AllElimTypes(e.meta, result, ty, (e ,len(type_args)))
+            result = AllElimTypes(e.meta, result, ty, (i, len(type_args)))
         return result
     elif e.data == 'some_intro':
         witnesses = parse_tree_to_list(e.children[0], e)
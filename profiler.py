@@ -0,0 +1,272 @@
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+from pathlib import Path
+import gc
+import html
+import json
+import os
+import sys
+import tracemalloc
+from flags import get_profile, get_heatmap, get_trace_file, get_memory_profile
+
+# Maps (module, phase, item) to [calls, total seconds, self seconds],
+# where item is the name of the declaration (or None) and self time
+# excludes the phases nested inside, such as the checking of an import.
+phase_times = {}
+
+# Maps (module, phase) to [peak bytes, retained bytes] when
+# --memory-profile is on. The peak is the most memory in use at any time
+# during the phase, and the retained memory is how much more is in use
+# at the end of the phase than at its start, not counting the phases
+# nested inside it.
+phase_memory = {}
+
+# For each phase that is running, innermost last, the time spent so far
+# in the phases nested inside it, the highest peak of memory seen so
+# far in the phase, and the memory retained by the nested phases.
+active_phases = []
+
+@contextmanager
+def profile_phase(module, phase, item=None):
+  if not get_profile() and get_trace_file() is None and not get_memory_profile():
+    yield
+    return
+  memory = get_memory_profile() and tracemalloc.is_tracing()
+  if memory:
+    # tracemalloc has a single peak, so it is reset at the start and end
+    # of each phase and the enclosing phase keeps the peaks it has seen.
+    (mem_start, peak) = tracemalloc.get_traced_memory()
+    if len(active_phases) > 0:
+      active_phases[-1][1] = max(active_phases[-1][1], peak)
+    tracemalloc.reset_peak()
+  nested = [0.0, 0, 0]
+  active_phases.append(nested)
+  start = perf_counter()
+  try:
+    yield
+  finally:
+    end = perf_counter()
+    elapsed = end - start
+    active_phases.pop()
+    if len(active_phases) > 0:
+      active_phases[-1][0] += elapsed
+    if memory:
+      (mem_end, peak) = tracemalloc.get_traced_memory()
+      peak = max(peak, nested[1])
+      tracemalloc.reset_peak()
+      if len(active_phases) > 0:
+        active_phases[-1][1] = max(active_phases[-1][1], peak)
+        active_phases[-1][2] += mem_end - mem_start
+      record = phase_memory.setdefault((module, phase), [0, 0])
+      record[0] = max(record[0], peak)
+      record[1] += mem_end - mem_start - nested[2]
+    if get_profile():
+      record = phase_times.setdefault((module, phase, item), [0, 0.0, 0.0])
+      record[0] += 1
+      record[1] += elapsed
+      record[2] += elapsed - nested[0]
+    trace_span(phase if item is None else phase + ' ' + item, phase,
+               start, end, {'module': module})
+
+def reset_profile():
+  phase_times.clear()
+  phase_memory.clear()
+  active_phases.clear()
+
+def totals_by(key):
+  totals = {}
+  for ((module, phase, item), (calls, total, self_time)) in phase_times.items():
+    k = key(module, phase, item)
+    if k is None:
+      continue
+    t = totals.setdefault(k, [0, 0.0])
+    t[0] += calls
+    t[1] += self_time
+  return sorted(totals.items(), key=lambda kv: kv[1][1], reverse=True)
+
+def profile_report(num_items=20):
+  lines = ['phase profile (self seconds, excluding nested phases)']
+  lines.append('by phase:')
+  for (phase, (calls, secs)) in totals_by(lambda m, p, i: p):
+    lines.append(f'  {phase:<24}{secs:10.3f}  ({calls} calls)')
+  lines.append('by module:')
+  for (module, (calls, secs)) in totals_by(lambda m, p, i: m):
+    lines.append(f'  {module:<24}{secs:10.3f}')
+  lines.append('slowest declarations:')
+  items = totals_by(lambda m, p, i: None if i is None else (m, i))
+  for ((module, item), (calls, secs)) in items[:num_items]:
+    lines.append(f'  {module + "." + item:<40}{secs:10.3f}')
+  return '\n'.join(lines)
+
+def profile_json():
+  return {'phases': [{'module': module, 'phase': phase, 'item': item,
+                      'calls': calls, 'total': total, 'self': self_time}
+                     for ((module, phase, item), (calls, total, self_time))
+                     in phase_times.items()]}
+
+def write_profile_json(filename):
+  with open(filename, 'w', encoding='utf-8') as f:
+    json.dump(profile_json(), f, indent=2)
+
+def ast_memory():
+  """The number and shallow size in bytes of the live AST nodes, by class."""
+  from abstract_syntax import AST
+  sizes = {}
+  for obj in gc.get_objects():
+    if isinstance(obj, AST):
+      size = sys.getsizeof(obj)
+      if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+      entry = sizes.setdefault(type(obj).__name__, [0, 0])
+      entry[0] += 1
+      entry[1] += size
+  return sizes
+
+def memory_report(num_types=15):
+  mb = lambda n: f'{n / 2**20:10.1f}'
+  (current, peak) = tracemalloc.get_traced_memory()
+  lines = ['memory profile (MB)',
+           f'  in use at exit{"":13}{mb(current)}',
+           f'  highest peak of any phase{"":2}{mb(max([p for (p, r) in phase_memory.values()], default=peak))}']
+  lines.append(f'{"by phase:":<30}{"peak":>10}{"retained":>10}')
+  by_phase = {}
+  by_module = {}
+  for ((module, phase), (peak, retained)) in phase_memory.items():
+    for (d, k) in [(by_phase, phase), (by_module, module)]:
+      entry = d.setdefault(k, [0, 0])
+      entry[0] = max(entry[0], peak)
+      entry[1] += retained
+  for (name, d) in [('by phase:', by_phase), ('by module:', by_module)]:
+    if name != 'by phase:':
+      lines.append(name)
+    for (k, (peak, retained)) in sorted(d.items(), key=lambda kv: kv[1][0], reverse=True):
+      lines.append(f'  {k:<28}{mb(peak)}{mb(retained)}')
+  lines.append(f'{"live AST nodes:":<30}{"count":>10}{"KB":>10}')
+  sizes = sorted(ast_memory().items(), key=lambda kv: kv[1][1], reverse=True)
+  for (cls, (n, size)) in sizes[:num_types]:
+    lines.append(f'  {cls:<28}{n:10}{size / 2**10:10.1f}')
+  return '\n'.join(lines)
+
+# Running totals of the work done by the checker (function calls reduced
+# and rewrites applied), so that the cost of a proof step can be
+# measured as the difference before and after it.
+work = {'reductions': 0, 'rewrites': 0}
+
+# Maps (filename, line) to [visits, self seconds, reductions, rewrites]
+# for the proof steps that start on that line.
+line_costs = {}
+
+# For each proof step being checked, innermost last, the time and work
+# spent so far in the proof steps nested inside it.
+active_steps = []
+
+def proof_cost(check):
+  """Wrap check_proof or check_proof_of so that the time and work of
+  each proof step is charged to the line where it starts, excluding the
+  nested steps, for the heat map and the trace."""
+  @wraps(check)
+  def wrapper(proof, *args):
+    nested = [0.0, 0, 0]
+    active_steps.append(nested)
+    start = (perf_counter(), work['reductions'], work['rewrites'])
+    try:
+      return check(proof, *args)
+    finally:
+      spent = (perf_counter() - start[0], work['reductions'] - start[1],
+               work['rewrites'] - start[2])
+      active_steps.pop()
+      if len(active_steps) > 0:
+        for i in range(3):
+          active_steps[-1][i] += spent[i]
+      loc = proof.location
+      trace_span(type(proof).__name__, 'proof', start[0], start[0] + spent[0],
+                 {'line': getattr(loc, 'line', None)})
+      if get_heatmap() is not None and hasattr(loc, 'filename') and hasattr(loc, 'line'):
+        cost = line_costs.setdefault((loc.filename, loc.line), [0, 0.0, 0, 0])
+        cost[0] += 1
+        for i in range(3):
+          cost[i + 1] += spent[i] - nested[i]
+  return wrapper
+
+def heatmap_text(filename, lines):
+  out = [f'{"ms":>9} {"steps":>6} {"reduce":>7} {"rewrite":>7} | source']
+  for (n, text) in enumerate(lines, start=1):
+    cost = line_costs.get((filename, n))
+    if cost:
+      (visits, secs, reds, rws) = cost
+      out.append(f'{secs * 1000:9.2f} {visits:6} {reds:7} {rws:7} | {text}')
+    else:
+      out.append(f'{"":9} {"":6} {"":7} {"":7} | {text}')
+  return '\n'.join(out) + '\n'
+
+def heatmap_html(filename, lines):
+  hottest = max([c[1] for ((f, n), c) in line_costs.items() if f == filename],
+                default=0.0)
+  rows = []
+  for (n, text) in enumerate(lines, start=1):
+    cost = line_costs.get((filename, n))
+    if cost:
+      (visits, secs, reds, rws) = cost
+      heat = secs / hottest if hottest > 0 else 0.0
+      style = f' style="background: rgba(255, 80, 0, {heat:.2f})"'
+      cells = f'<td>{secs * 1000:.2f}</td><td>{visits}</td><td>{reds}</td><td>{rws}</td>'
+    else:
+      style = ''
+      cells = '<td></td><td></td><td></td><td></td>'
+    rows.append(f'<tr{style}>{cells}<td>{n}</td><td><pre>{html.escape(text)}</pre></td></tr>')
+  return '<!DOCTYPE html>\n<html><head><meta charset="utf-8">' \
+    + f'<title>{html.escape(filename)}</title>' \
+    + '<style>td { padding: 0 0.5em; text-align: right; font-family: monospace; }' \
+    + ' td pre { margin: 0; text-align: left; }</style></head><body>\n' \
+    + '<table><tr><th>ms</th><th>steps</th><th>reduce</th><th>rewrite</th>' \
+    + '<th>line</th><th>source</th></tr>\n' \
+    + '\n'.join(rows) + '\n</table></body></html>\n'
+
+def write_heatmaps(directory):
+  """Write an annotated copy of each source file with proof costs,
+  as <module>.heat.txt and <module>.heat.html in `directory`."""
+  os.makedirs(directory, exist_ok=True)
+  for filename in sorted({f for (f, n) in line_costs.keys()}):
+    if not os.path.isfile(filename):
+      continue
+    with open(filename, 'r', encoding='utf-8') as f:
+      lines = f.read().splitlines()
+    base = os.path.join(directory, Path(filename).stem + '.heat')
+    with open(base + '.txt', 'w', encoding='utf-8') as f:
+      f.write(heatmap_text(filename, lines))
+    with open(base + '.html', 'w', encoding='utf-8') as f:
+      f.write(heatmap_html(filename, lines))
+
+# The events of a Chrome trace (the Trace Event Format, which Perfetto
+# and chrome://tracing load), with timestamps in microseconds since
+# trace_start. Events are only recorded when --trace-json is given.
+trace_events = []
+trace_start = perf_counter()
+
+def trace_event(name, cat, ph, ts, fields):
+  if get_trace_file() is None:
+    return
+  event = {'name': name, 'cat': cat, 'ph': ph,
+           'ts': (ts - trace_start) * 1e6, 'pid': os.getpid(), 'tid': 0}
+  event.update(fields)
+  trace_events.append(event)
+
+def trace_span(name, cat, start, end, args=None):
+  trace_event(name, cat, 'X', start, {'dur': (end - start) * 1e6,
+                                      'args': args or {}})
+
+@contextmanager
+def traced(name, cat, args=None):
+  if get_trace_file() is None:
+    yield
+    return
+  start = perf_counter()
+  try:
+    yield
+  finally:
+    trace_span(name, cat, start, perf_counter(), args)
+
+def write_trace(filename):
+  with open(filename, 'w', encoding='utf-8') as f:
+    json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
@@ -23,8 +23,10 @@
 #    reduce some formulas and terms automatically.
 
 from abstract_syntax import *
-from error import error, incomplete_error, warning, error_header, IncompleteProof, match_failed, MatchFailed
+from error import error, lazy_error, incomplete_error, warning, error_header, IncompleteProof, match_failed, MatchFailed, DeferredError
 from flags import get_verbose, set_verbose, print_verbose, VerboseLevel
+from profiler import profile_phase, proof_cost
+from counters import count
 
 imported_modules = set()
 checked_modules = set()
@@ -38,7 +40,57 @@ def generate_name(name):
     name_id += 1
     return ls[0] + '.' + str(new_id)
   
+def implies_failed(e, frm1, frm2):
+  return DeferredError(thunk=lambda: str(e) + '\n\nWhile trying to prove that\n\t' \
+                       + str(frm1) + '\nimplies\n' + '\t' + str(frm2))
+
+# The implicit modus ponens in the And case below can ask the same
+# question many times, so each call to check_implies remembers the
+# implications it has already proved or refuted, and gives up after
+# a bounded number of steps.
+
+implies_step_limit = 100000
+
+class ImpliesSearch:
+  def __init__(self):
+    self.proved = set()
+    self.failed = {}
+    self.steps = 0
+
+  def exhausted(self):
+    return self.steps > implies_step_limit
+
 def check_implies(loc, frm1, frm2):
+  search = ImpliesSearch()
+  try:
+    check_implies_aux(loc, frm1, frm2, search)
+  except Exception as e:
+    if search.exhausted():
+      error(loc, '\nGave up trying to prove that\n\t' + str(frm1) + '\n' \
+            + 'implies\n\t' + str(frm2) + '\n' \
+            + 'after ' + str(implies_step_limit) + ' steps.\n' \
+            + 'Try proving some of the needed facts separately with `have`.')
+    raise
+
+def check_implies_aux(loc, frm1, frm2, search):
+  search.steps += 1
+  if search.exhausted():
+    # Fail quickly so that the search unwinds.
+    raise DeferredError('step limit reached')
+  key = (term_key(frm1), term_key(frm2))
+  if key in search.proved:
+    return
+  if key in search.failed:
+    raise search.failed[key]
+  try:
+    check_implies_cases(loc, frm1, frm2, search)
+  except Exception as e:
+    if not search.exhausted():
+      search.failed[key] = e
+    raise
+  search.proved.add(key)
+
+def check_implies_cases(loc, frm1, frm2, search):
   if get_verbose():
     print('check_implies? ' + str(frm1) + ' => ' + str(frm2))
   match (frm1, frm2):
@@ -48,22 +100,16 @@ def check_implies(loc, frm1, frm2):
     case (_, And(loc2, tyof2, args)):
       try:
         for arg2 in args:
-          check_implies(loc, frm1, arg2)
+          check_implies_aux(loc, frm1, arg2, search)
       except Exception as e:
-          msg = str(e) + '\n\nWhile trying to prove that\n\t' + str(frm1) \
-              + '\nimplies\n'\
-              + '\t' + str(frm2)
-          raise Exception(msg)
+          raise implies_failed(e, frm1, frm2)
         
     case(Or(loc1, tyof1, args1), _):
       for arg1 in args1:
         try:
-          check_implies(loc, arg1, frm2)
+          check_implies_aux(loc, arg1, frm2, search)
         except Exception as e:
-          msg = str(e) + '\n\nWhile trying to prove that\n\t' + str(frm1) \
-              + '\nimplies\n'\
-              + '\t' + str(frm2)
-          raise Exception(msg)
+          raise implies_failed(e, frm1, frm2)
       
     case (Bool(loc2, tyof2, False), _):
       return
@@ -71,61 +117,55 @@ def check_implies(loc, frm1, frm2):
     case (And(loc2, tyof2, args1), _):
       for arg1 in args1:
         try:
-          check_implies(loc, arg1, frm2)
+          check_implies_aux(loc, arg1, frm2, search)
           return
         except Exception as e:
           # implicit modus ponens
           match arg1:
             case IfThen(loc3, tyof3, prem, conc):
               try:
-                  check_implies(loc, conc, frm2)
+                  check_implies_aux(loc, conc, frm2, search)
                   rest = And(loc2, tyof2, [arg for arg in args1 if arg != arg1])
-                  check_implies(loc, rest, prem)
+                  check_implies_aux(loc, rest, prem, search)
                   return
               except Exception as e2:
                   pass
             case _:
               pass
           continue
-      error(loc, '\nCould not prove that\n\t' + str(frm1) + '\n' \
-            + 'implies\n\t' + str(frm2) + '\n' \
-            + 'because we could not prove at least one of\n'
-            + '\n'.join(['\t' + str(arg1) + '   implies   ' + str(frm2)\
-                         for arg1 in args1]))
+      lazy_error(loc, lambda: '\nCould not prove that\n\t' + str(frm1) + '\n' \
+                 + 'implies\n\t' + str(frm2) + '\n' \
+                 + 'because we could not prove at least one of\n'
+                 + '\n'.join(['\t' + str(arg1) + '   implies   ' + str(frm2)\
+                              for arg1 in args1]))
             
     case (_, Or(loc2, tyof2, args2)):
       for arg2 in args2:
         try:
-          check_implies(loc, frm1, arg2)
+          check_implies_aux(loc, frm1, arg2, search)
           return
         except Exception as e:
           continue
-      error(loc, '\nCould not prove that\n\t' + str(frm1) + '\n' \
-            + 'implies\n\t' + str(frm2) + '\n' \
-            + 'because we could not prove at least one of\n'
-            + '\n'.join(['\t' + str(frm1) + '   implies   ' + str(arg2)\
-                         for arg2 in args2]))
+      lazy_error(loc, lambda: '\nCould not prove that\n\t' + str(frm1) + '\n' \
+                 + 'implies\n\t' + str(frm2) + '\n' \
+                 + 'because we could not prove at least one of\n'
+                 + '\n'.join(['\t' + str(frm1) + '   implies   ' + str(arg2)\
+                              for arg2 in args2]))
       
     case (IfThen(loc1, tyof1, prem1, conc1), IfThen(loc2, tyof2, prem2, conc2)):
       try:
-        check_implies(loc, prem2, prem1)
-        check_implies(loc, conc1, conc2)
+        check_implies_aux(loc, prem2, prem1, search)
+        check_implies_aux(loc, conc1, conc2, search)
       except Exception as e:
-        msg = str(e) + '\n\nWhile trying to prove that\n\t' + str(frm1) \
-            + '\nimplies\n'\
-            + '\t' + str(frm2)
-        raise Exception(msg)
+        raise implies_failed(e, frm1, frm2)
       
     case (All(loc1, tyof1, var1, _, body1), All(loc2, tyof2, var2, _, body2)):
       try:
           sub = { var2[0]: Var(loc2, var1[1], var1[0], []) }
           body2a = body2.substitute(sub)
-          check_implies(loc, body1, body2a)
+          check_implies_aux(loc, body1, body2a, search)
       except Exception as e:
-        msg = str(e) + '\n\nWhile trying to prove that\n\t' + str(frm1) \
-            + '\nimplies\n'\
-            + '\t' + str(frm2)
-        raise Exception(msg)
+        raise implies_failed(e, frm1, frm2)
 
     case (All(loc1, tyof1, vars1, _, body1), _):
        matching = {}
@@ -133,28 +173,31 @@ def check_implies(loc, frm1, frm2):
          vars, body = collect_all(frm1)
          formula_match(loc, vars, body, frm2, matching, Env())
        except MatchFailed as e:
-         error(loc, '\nCould not prove that\n\t' + str(frm1) \
-                  + '\ninstantiates to\n\t' + str(frm2) \
-               + '\nbecause\n' + str(e))
+         reason = e
+         lazy_error(loc, lambda: '\nCould not prove that\n\t' + str(frm1) \
+                    + '\ninstantiates to\n\t' + str(frm2) \
+                    + '\nbecause\n' + str(reason))
        
     case _:
       if frm1 != frm2:
-        diff = isolate_difference(frm1, frm2)
-        if diff:
-          (small_frm1, small_frm2) = diff
-          if small_frm1 != frm1:
-              msg = 'error, the proved formula:\n' \
-                  + '\t' + str(frm1) + '\n' \
-              + 'does not match the goal:\n' \
-              + '\t' + str(frm2) + '\n' \
-              + 'because\n\t' + str(small_frm1) + '\n\t≠ ' + str(small_frm2) + '\n' 
-              error(loc, msg)
-          else:
-              error(loc, '\nYou provided a proof of:\n\t' + str(frm1) \
-                    + '\nbut that is different from what you need to prove:\n\t' + str(frm2))
-        else:
-            error(loc, 'internal error, could not isolate difference for\n\t' \
-                  + str(frm1) + '\nand\n\t' + str(frm2))
+        lazy_error(loc, lambda: not_implied_msg(frm1, frm2))
+
+def not_implied_msg(frm1, frm2):
+  diff = isolate_difference(frm1, frm2)
+  if diff:
+    (small_frm1, small_frm2) = diff
+    if small_frm1 != frm1:
+      return 'error, the proved formula:\n' \
+        + '\t' + str(frm1) + '\n' \
+        + 'does not match the goal:\n' \
+        + '\t' + str(frm2) + '\n' \
+        + 'because\n\t' + str(small_frm1) + '\n\t≠ ' + str(small_frm2) + '\n'
+    else:
+      return '\nYou provided a proof of:\n\t' + str(frm1) \
+        + '\nbut that is different from what you need to prove:\n\t' + str(frm2)
+  else:
+    return 'internal error, could not isolate difference for\n\t' \
+      + str(frm1) + '\nand\n\t' + str(frm2)
                     
 def instantiate(loc, allfrm, arg):
   match allfrm:
@@ -185,19 +228,15 @@ def pattern_to_term(pat):
 def rewrite(loc, formula, equation, env):
     if False and get_verbose():
         print('rewriting ' + str(formula) + '\n\twith ' + str(equation))
-    num_marks = count_marks(formula)
-    if num_marks == 0:
+    mark = locate_mark(formula)
+    if mark.num_marks == 0:
         ret = rewrite_aux(loc, formula, equation, env)
         print_verbose(lambda: '\trewrote ' + str(formula) + '\n\t    ==> ' + str(ret) \
                       + '\n\tusing ' + str(equation))
         return ret
-    elif num_marks == 1:
-        try:
-            find_mark(formula)
-            error(loc, 'in replace, find_mark failed on formula:\n\t' + str(formula))
-        except MarkException as ex:
-            new_subject = rewrite_aux(loc, ex.subject, equation, env)
-            return replace_mark(formula, new_subject)
+    elif mark.num_marks == 1:
+        new_subject = rewrite_aux(loc, mark.subject, equation, env)
+        return mark.plug(new_subject)
     else:
         error(loc, 'in replace, formula contains more than one mark:\n\t' + str(formula))
 
@@ -298,7 +337,7 @@ def check_proof(proof, env):
       results = []
       for fact in facts:
         new_fact = type_check_term(fact, BoolType(loc), env, None, [])
-        if new_fact in env.local_proofs():
+        if env.has_local_proof(new_fact):
             results.append(new_fact)
         else:
             error(loc, 'Could not find a proof of\n\t' + str(new_fact) \
@@ -314,7 +353,7 @@ def check_proof(proof, env):
     case EvaluateFact(loc, subject):
       formula = check_proof(subject, env)
       set_reduce_all(True)
-      red_formula = formula.reduce(env)
+      red_formula = cached_reduce(formula, env)
       set_reduce_all(False)
       ret = red_formula
           
@@ -326,14 +365,14 @@ def check_proof(proof, env):
     case RewriteFact(loc, subject, equation_proofs):
       formula = check_proof(subject, env)
       eqns = [check_proof(proof, env) for proof in equation_proofs]
-      red_formula = formula.reduce(env)
+      red_formula = cached_reduce(formula, env)
       current_formula = red_formula
       current_formula = apply_rewrites(loc, current_formula, eqns, env)
       ret = current_formula
 
     case SimplifyFact(loc, subject):
       formula = check_proof(subject, env)
-      ret = formula.reduce(env)
+      ret = cached_reduce(formula, env)
       
     case PHole(loc):
       incomplete_error(loc, 'unfinished proof')
@@ -481,11 +520,11 @@ def check_proof(proof, env):
         case And(loc2, tyof, args):
           pass
         case _:
-          ifthen = ifthen.reduce(env)
+          ifthen = cached_reduce(ifthen, env)
       match ifthen:
         case IfThen(loc2, tyof, prem, conc):
           check_proof_of(arg, prem, env)
-          ret = conc.reduce(env)
+          ret = cached_reduce(conc, env)
         case And(loc2, tyof, args):
           vars, imps = collect_all_if_then(loc, ifthen, env)
           arg_frm = check_proof(arg, env)
@@ -528,7 +567,7 @@ def check_proof(proof, env):
                                + str(x) + '\n' \
                                + 'for application of\n\t' + str(ifthen) + '\n'\
                                + 'to\n\t' + str(arg) + ': ' + str(arg_frm))
-              rets.append(conc.substitute(matching).reduce(env))
+              rets.append(cached_reduce(conc.substitute(matching), env))
             except MatchFailed as e:
               reasons.append(e)
           if len(rets) == 1: ret = rets[0]
@@ -580,8 +619,8 @@ def check_proof(proof, env):
       eq2 = check_proof(eq_pf2, env)
       (a,b1) = split_equation(loc, eq1, env)
       (b2,c) = split_equation(loc, eq2, env)
-      b1r = b1.reduce(env)
-      b2r = b2.reduce(env)
+      b1r = cached_reduce(b1, env)
+      b2r = cached_reduce(b2, env)
       if b1r != b2r:
         error(loc, 'error in transitive,\nyou proved\n\t'
               + str(eq1) + '\nand\n\t' + str(eq2) + '\n' \
@@ -748,7 +787,7 @@ def gen_custom_induction_advice(conjuncts):
 def proof_advice(formula, env):
     prefix = 'Advice:\n'
 
-    red_formula = formula.reduce(env)
+    red_formula = cached_reduce(formula, env)
     if formula != red_formula:
         prefix += '\tThis goal simplifies to\n\t\t' + str(red_formula) + '\n' \
             + '\tConsider using\n\t\tsimplify\n\n'
@@ -885,15 +924,15 @@ def proof_advice(formula, env):
       case TLet(loc2, _, var, rhs, body):
         return proof_advice(body, env)
       case _:
-        for (name, b) in env.dict.items():
-            if isinstance(b, ProofBinding) and b.local and b.formula == formula:
-                msg = '\nYou can conclude the proof with:\n'
-                if base_name(name) == '_':
-                    msg += '\trecall ' + str(formula)
-                else:
-                    msg += '\tconclude ' + str(formula) \
-                        + ' by ' + base_name(name)                
-                return msg
+        name = env.find_local_proof(formula)
+        if name is not None:
+            msg = '\nYou can conclude the proof with:\n'
+            if base_name(name) == '_':
+                msg += '\trecall ' + str(formula)
+            else:
+                msg += '\tconclude ' + str(formula) \
+                    + ' by ' + base_name(name)
+            return msg
 
         return '\n'
 
@@ -927,8 +966,8 @@ def check_proof_of(proof, formula, env):
     case PReflexive(loc):
       match formula:
         case Call(loc2, tyof2, Var(loc3, tyof3, '=', rs), [lhs, rhs]):
-          lhsNF = lhs.reduce(env)
-          rhsNF = rhs.reduce(env)
+          lhsNF = cached_reduce(lhs, env)
+          rhsNF = cached_reduce(rhs, env)
           if lhsNF != rhsNF:
             (small_lhs, small_rhs) = isolate_difference(lhsNF, rhsNF)
             msg = 'error in proof by reflexive:\n'
@@ -956,8 +995,8 @@ def check_proof_of(proof, formula, env):
       
       check_proof_of(eq_pf2, mkEqual(loc, b, c), env)
       
-      a1r = a1.reduce(env)
-      a2r = a2.reduce(env)
+      a1r = cached_reduce(a1, env)
+      a2r = cached_reduce(a2, env)
       if remove_mark(a1r) != remove_mark(a2r):
         error(loc, 'for transitive, from proofs of\n'
               + '\t' + str(eq1) + '\n'
@@ -1039,7 +1078,7 @@ def check_proof_of(proof, formula, env):
           body_env = env.declare_term_vars(loc, witnesses_types)
           if prop:
             prop = check_formula(prop, body_env)
-            check_implies(loc, witnessFormula.reduce(env), prop.reduce(body_env))
+            check_implies(loc, cached_reduce(witnessFormula, env), cached_reduce(prop, body_env))
           else:
             prop = witnessFormula
           body_env = body_env.declare_local_proof_var(loc, label, prop)
@@ -1064,8 +1103,8 @@ def check_proof_of(proof, formula, env):
       new_prem1 = check_formula(prem1, env)
       match formula:
         case IfThen(loc2, tyof, prem2, conc):
-          prem1_red = new_prem1.reduce(env)
-          prem2_red = prem2.reduce(env)
+          prem1_red = cached_reduce(new_prem1, env)
+          prem2_red = cached_reduce(prem2, env)
           if prem1_red != prem2_red:
             (small1, small2) = isolate_difference(prem1_red, prem2_red)
             msg = str(prem1_red) + ' ≠ ' + str(prem2_red) + '\n' \
@@ -1081,13 +1120,14 @@ def check_proof_of(proof, formula, env):
       new_rhs = type_synth_term(rhs, env, None, [])
       body_env = env.define_term_var(loc, var, new_rhs.typeof, new_rhs)
       equation = mkEqual(loc, new_rhs, Var(loc, None, var, [])).reduce(env)
-      red_formula = formula.reduce(env)
+      red_formula = cached_reduce(formula, env)
       if get_verbose():
           print('define ' + str(var) + '\n\trewrite with ' + str(equation) + '\n\tin ' \
                 + str(red_formula))
-      frm = rewrite(loc, red_formula, equation, env)
+      rule = RewriteRule(loc, equation, env)
+      frm = rewrite(loc, red_formula, rule, env)
       new_body_env = Env({k: ProofBinding(b.location, \
-                                          rewrite(loc, b.formula, equation, env), \
+                                          rewrite(loc, b.formula, rule, env), \
                                           b.local, module=env.get_current_module()) \
                           if isinstance(b, ProofBinding) else b \
                            for (k,b) in body_env.dict.items()})
@@ -1115,16 +1155,16 @@ def check_proof_of(proof, formula, env):
           check_proof_of(reason, formula, env)
           error(loc, '\nneed to show:\n\t' + str(formula))
         case _:
-          claim_red = new_claim.reduce(env)
-          formula_red = formula.reduce(env)
-          check_implies(loc, remove_mark(claim_red).reduce(env),
-                        remove_mark(formula_red).reduce(env))
+          claim_red = cached_reduce(new_claim, env)
+          formula_red = cached_reduce(formula, env)
+          check_implies(loc, cached_reduce(remove_mark(claim_red), env),
+                        cached_reduce(remove_mark(formula_red), env))
           check_proof_of(reason, claim_red, env)
 
     case EvaluateGoal(loc):
       set_reduce_all(True)
       set_dont_reduce_opaque(True)
-      red_formula = remove_mark(formula).reduce(env)
+      red_formula = cached_reduce(remove_mark(formula), env)
       set_reduce_all(False)
       set_dont_reduce_opaque(False)
       if red_formula != Bool(loc, None, True):
@@ -1147,8 +1187,8 @@ def check_proof_of(proof, formula, env):
         new_claim = type_check_term(claim, BoolType(loc), env, None, [])
         set_reduce_all(True)
         set_dont_reduce_opaque(True)
-        new_formula = formula.reduce(env)
-        red_claim = new_claim.reduce(env)
+        new_formula = cached_reduce(formula, env)
+        red_claim = cached_reduce(new_claim, env)
         set_reduce_all(False)
         set_dont_reduce_opaque(False)
 
@@ -1170,7 +1210,7 @@ def check_proof_of(proof, formula, env):
             check_proof_of(rest, new_claim, env)
       else:
         new_claim = type_check_term(claim, BoolType(loc), env, None, [])
-        claim_red = new_claim.reduce(env)
+        claim_red = cached_reduce(new_claim, env)
 
         match claim_red:
           case Hole(loc2, tyof):
@@ -1197,7 +1237,7 @@ def check_proof_of(proof, formula, env):
 
     case PTuple(loc, pfs):
       try:
-        red_formula = formula.reduce(env)
+        red_formula = cached_reduce(formula, env)
         match red_formula:
           case And(loc2, tyof2, frms):
             for (frm,pf) in zip(frms, pfs):
@@ -1212,8 +1252,8 @@ def check_proof_of(proof, formula, env):
       except Exception as ex1:
         try:
           form = check_proof(proof, env)
-          form_red = form.reduce(env)
-          formula_red = formula.reduce(env)
+          form_red = cached_reduce(form, env)
+          formula_red = cached_reduce(formula, env)
           check_implies(proof.location, form_red, remove_mark(formula_red))
         except Exception as ex2:
           error(loc, 'failed to prove: ' + str(formula) + '\n' \
@@ -1414,8 +1454,8 @@ def check_proof_of(proof, formula, env):
 
             if len(assumptions) > 1:
               error(scase.location, 'only one assumption is allowed in a switch case')
-            frm = rewrite(loc, formula.reduce(env), equation.reduce(env), env)
-            new_frm = frm.reduce(env)
+            frm = rewrite(loc, cached_reduce(formula, env), cached_reduce(equation, env), env)
+            new_frm = cached_reduce(frm, env)
             check_proof_of(scase.body, new_frm, body_env)
         case TypeType(_):
           # As far as I know, it is not possible to switch on a type
@@ -1469,7 +1509,7 @@ def check_proof_of(proof, formula, env):
                   frm = formula.substitute({new_subject.name: new_subject_case})
                 else:
                   frm = formula
-                red_frm = frm.reduce(body_env)
+                red_frm = cached_reduce(frm, body_env)
                 check_proof_of(scase.body, red_frm, body_env)
             case _:
               error(loc, "switch expected union type or bool, not " + str(ty))
@@ -1477,31 +1517,31 @@ def check_proof_of(proof, formula, env):
     case RewriteGoal(loc, equation_proofs, body):
       equations = [check_proof(proof, env) for proof in equation_proofs]
       #print('replacing ' + ', '.join(str(eq) for eq in equations))
-      eqns = [equation.reduce(env) for equation in equations]
+      eqns = [cached_reduce(equation, env) for equation in equations]
       #print('reduced: ' + ', '.join(str(eq) for eq in eqns))
       #print('formula: ' + str(formula))
-      new_formula = formula.reduce(env)
+      new_formula = cached_reduce(formula, env)
       #print('new_formula: ' + str(new_formula))
       new_formula = apply_rewrites(loc, new_formula, eqns, env)
       check_proof_of(body, new_formula, env)
 
     case SimplifyGoal(loc, body):
-      new_formula = formula.reduce(env)
+      new_formula = cached_reduce(formula, env)
       check_proof_of(body, new_formula, env)
       
     case ApplyDefsGoal(loc, defs, body):
       #print('expanding definitions: ' + ', '.join([str(d) for d in defs]))
       new_formula = expand_definitions(loc, formula, defs, env)
       #print('expanded formula: ' + str(new_formula))
-      red_formula = new_formula.reduce(env)
+      red_formula = cached_reduce(new_formula, env)
       #print('reduced formula: ' + str(red_formula))
       check_proof_of(body, red_formula, env)
       
     case _:
       try:
         form = check_proof(proof, env)
-        form_red = form.reduce(env)
-        formula_red = remove_mark(formula).reduce(env)
+        form_red = cached_reduce(form, env)
+        formula_red = cached_reduce(remove_mark(formula), env)
         check_implies(proof.location, form_red, formula_red)
       except IncompleteProof as e:
         raise e
@@ -1517,16 +1557,11 @@ def check_proof_of(proof, formula, env):
 
 
 def expand_definitions(loc, formula, defs, env):
-  num_marks = count_marks(formula)
-  if num_marks == 0:
+  mark = locate_mark(formula)
+  if mark.num_marks == 0:
       new_formula = formula
-  elif num_marks == 1:
-      try:
-          find_mark(formula)
-          error(loc, 'in expand_definitions, find_mark failed on formula:\n\t' \
-                + str(formula))
-      except MarkException as ex:
-          new_formula = ex.subject
+  elif mark.num_marks == 1:
+      new_formula = mark.subject
   else:
       error(loc, 'in expand, formula contains more than one mark:\n\t' \
             + str(formula))
@@ -1582,55 +1617,87 @@ def expand_definitions(loc, formula, defs, env):
                 + name2str(var.name) \
                 + ' in:\n' + '\t' + str(new_formula))
 
-  if num_marks == 0:          
+  if mark.num_marks == 0:          
       return check_formula(new_formula, env)
   else:
-      return check_formula(replace_mark(formula, new_formula).reduce(env), env)
+      return check_formula(cached_reduce(mark.plug(new_formula), env), env)
 
 def apply_rewrites(loc, formula, eqns, env):#
-  num_marks = count_marks(formula)
-  if num_marks == 0:
+  mark = locate_mark(formula)
+  if mark.num_marks == 0:
       new_formula = formula
-  elif num_marks == 1:
-      try:
-          find_mark(formula)
-          error(loc, 'in apply_rewrites, find_mark failed on formula:\n\t' + str(formula))
-      except MarkException as ex:
-          new_formula = ex.subject
+  elif mark.num_marks == 1:
+      new_formula = mark.subject
   else:
       error(loc, 'in rewrite, formula contains more than one mark:\n\t' + str(formula))
 
+  # The equations are applied one at a time, reducing in between,
+  # because a later equation may only match the reduced result of an
+  # earlier one (e.g. IH after summation_add in the proof of sum_n
+  # in lib/Nat.pf).
   for eq in eqns:
     if is_true(eq):
         error(loc, 'no need for replace because this equation is handled automatically')
     if not is_equation(eq):
         error(loc, 'in replace, expected an equation, not:\n\t' + str(eq)
               + '\n\twhile replacing ' + ', '.join([str(eq) for eq in eqns]))
+    rule = RewriteRule(loc, eq, env)
     reset_num_rewrites()
-    new_formula = rewrite_aux(loc, new_formula, eq, env)
+    new_formula = rewrite_aux(loc, new_formula, rule, env)
     if get_num_rewrites() == 0:
-        (lhs, rhs) = split_equation(loc, eq, env)
-        error(loc, '\ncould not find any matches for\n\t' + str(lhs) \
+        error(loc, '\ncould not find any matches for\n\t' + str(rule.lhs) \
               + '\nin\n\t' + str(new_formula) \
               + '\nwhile trying to replace using the below equation, left to right\n\t' + str(eq))
-    new_formula = new_formula.reduce(env)
+    new_formula = cached_reduce(new_formula, env)
       
-  if num_marks == 0:          
+  if mark.num_marks == 0:          
       return new_formula
   else:
-      return replace_mark(formula, new_formula).reduce(env)
+      return cached_reduce(mark.plug(new_formula), env)
 
     
+def type_check_arg(i, arg, param_type, env, recfun, subterms, arg_memo):
+  """Check the i-th argument of a call against `param_type`. When trying
+  the overloads of a function, `arg_memo` remembers the outcome for each
+  argument and parameter type, so that nested calls to overloaded
+  functions are not checked again for every overload of the outer call."""
+  if arg_memo is None:
+    return type_check_term(arg, param_type, env, recfun, subterms)
+  key = (i, term_key(param_type))
+  if key not in arg_memo:
+    try:
+      arg_memo[key] = (True, type_check_term(arg, param_type, env, recfun, subterms))
+    except Exception as e:
+      arg_memo[key] = (False, e)
+  (ok, result) = arg_memo[key]
+  if ok:
+    return result
+  raise result
+
+def type_synth_arg(i, arg, env, recfun, subterms, arg_memo):
+  if arg_memo is None:
+    return type_synth_term(arg, env, recfun, subterms)
+  key = (i, None)
+  if key not in arg_memo:
+    try:
+      arg_memo[key] = (True, type_synth_term(arg, env, recfun, subterms))
+    except Exception as e:
+      arg_memo[key] = (False, e)
+  (ok, result) = arg_memo[key]
+  if ok:
+    return result
+  raise result
+
 def type_check_call_funty(loc, new_rator, args, env, recfun, subterms, ret_ty,
-                          call, typarams, param_types, return_type):
+                          call, typarams, param_types, return_type, arg_memo=None):
   is_assoc = is_associative(loc, rator_name(new_rator), return_type, env)
   if get_verbose():
       print('is_assoc? ' + rator_name(new_rator) + ' : ' + str(return_type) + ' = ' + str(is_assoc))
   if (is_assoc and len(args) < len(param_types)) \
       or ((not is_assoc) and len(args) != len(param_types)):
-    error(loc, 'incorrect number of arguments in call:\n\t' + str(call) \
-          + '\n\texpected ' + str(len(param_types)) \
-          + ' arguments, not ' + str(len(args)))
+    lazy_error(loc, lambda: 'incorrect number of arguments in call:\n\t' + str(call) \
+               + '\n\texpected ' + str(len(param_types)) \
+               + ' arguments, not ' + str(len(args)))
   # We force associative operators to have the same param type
   if is_assoc:
     param_types = [param_types[0]] * len(args)
@@ -1638,11 +1705,11 @@ def type_check_call_funty(loc, new_rator, args, env, recfun, subterms, ret_ty,
   if len(typarams) == 0:
     #print('type check call to regular: ' + str(call))
     new_args = []
-    for (param_type, arg) in zip(param_types, args):
-      new_args.append(type_check_term(arg, param_type, env, recfun, subterms))
+    for (i, (param_type, arg)) in enumerate(zip(param_types, args)):
+      new_args.append(type_check_arg(i, arg, param_type, env, recfun, subterms, arg_memo))
     if ret_ty != None and ret_ty != return_type:
-      error(loc, 'expected ' + str(ret_ty) \
-            + ' but the call returns ' + str(return_type))
+      lazy_error(loc, lambda: 'expected ' + str(ret_ty) \
+                 + ' but the call returns ' + str(return_type))
     return Call(loc, return_type, new_rator, new_args)
   else:
     #print('type check call to generic: ' + str(call))
@@ -1653,20 +1720,20 @@ def type_check_call_funty(loc, new_rator, args, env, recfun, subterms, ret_ty,
       try:
           type_match(loc, type_params, return_type, ret_ty, matching)
       except Exception as e:
-        new_msg = 'expected type ' + str(ret_ty) + '\n' \
+        inferred = dict(matching)
+        lazy_error(call.location, lambda: 'expected type ' + str(ret_ty) + '\n' \
             + '\tbut the call ' + str(call) + '\n' \
             + '\thas return type ' + str(return_type) + '\n\n' \
             + '\tinferred type arguments: ' \
             + ', '.join([base_name(x) + ' := ' + str(ty) \
-                         for (x,ty) in matching.items()])
-        error(call.location, new_msg)
+                         for (x,ty) in inferred.items()]))
           
     # If we have already deduced the type parameters in the parameter type,
     # then we can check the term. Otherwise, we synthesize the term's type
     # and match it against the parameter type.
     try:
       new_args = []
-      for (arg, param_ty) in zip(args, param_types):
+      for (i, (arg, param_ty)) in enumerate(zip(args, param_types)):
           param_type = param_ty.substitute(matching)
           fvs = param_type.free_vars()\
                           .intersection(set([ty.name for ty in type_params]))
@@ -1675,26 +1742,27 @@ def type_check_call_funty(loc, new_rator, args, env, recfun, subterms, ret_ty,
             print('param_type = ' + str(param_type))
             print('fvs = ' + ', '.join([base_name(x) for x in fvs]) + '\n')
           if len(fvs) == 0:
-            new_arg = type_check_term(arg, param_type, env, recfun, subterms)
+            new_arg = type_check_arg(i, arg, param_type, env, recfun, subterms, arg_memo)
           else:
-            new_arg = type_synth_term(arg, env, recfun, subterms)
+            new_arg = type_synth_arg(i, arg, env, recfun, subterms, arg_memo)
             type_match(loc, type_params, param_type, new_arg.typeof, matching)
           new_args.append(new_arg)
     except Exception as e:
-        new_msg = str(e) + '\n\n\t' + 'in context of call ' + str(call) + '\n' \
+        reason = e
+        inferred = dict(matching)
+        raise DeferredError(thunk=lambda: str(reason) + '\n\n\t' + 'in context of call ' + str(call) + '\n' \
             + '\tfunction type: ' + str(FunctionType(loc, typarams, param_types,
                                                      return_type)) + '\n' \
             + '\tinferred type arguments: ' \
-            + ', '.join([base_name(x) + ' := ' + str(ty) for (x,ty) in matching.items()])
-        raise Exception(new_msg)
+            + ', '.join([base_name(x) + ' := ' + str(ty) for (x,ty) in inferred.items()]))
     
     # Were all the type parameters deduced?
     for x in typarams:
         if x not in matching.keys():
-            error(loc, 'in call ' + str(call) \
-                  + '\n\tcould not deduce a type for ' \
-                  + base_name(x) + ' to instantiate ' + str(call.rator) \
-                  + '\n\twhose type is: ' + str(new_rator.typeof))
+            lazy_error(loc, lambda: 'in call ' + str(call) \
+                       + '\n\tcould not deduce a type for ' \
+                       + base_name(x) + ' to instantiate ' + str(call.rator) \
+                       + '\n\twhose type is: ' + str(new_rator.typeof))
 
     type_args = [matching[x] for x in typarams]
     inst_params = [p.substitute(matching) for p in param_types]
@@ -1710,23 +1778,83 @@ def type_check_call_funty(loc, new_rator, args, env, recfun, subterms, ret_ty,
     # print('}}}')
     return ret
 
+# Overload resolution for calls whose arguments are variables of known
+# types depends only on those types, the expected type, and which of
+# the overloads are associative. This maps those to the overload that
+# was the unique match.
+overload_cache = {}
+
+def simple_arg_type(arg, env):
+  """The type of `arg` if it is a variable whose type determines whether
+  it checks against a parameter type, otherwise None."""
+  match arg:
+    case Var(loc, _, name, rs) if len(rs) <= 1:
+      ty = env.get_type_of_term_var(arg)
+      match ty:
+        case None | OverloadType() | FunctionType() | GenericUnknownInst():
+          return None
+        case _:
+          return ty
+    case _:
+      return None
+
+def overload_cache_key(overloads, args, env, ret_ty, assoc_flags):
+  arg_keys = []
+  for arg in args:
+    ty = simple_arg_type(arg, env)
+    if ty is None:
+      return None
+    arg_keys.append(term_key(ty))
+  return (tuple(x for (x, funty) in overloads), tuple(arg_keys),
+          term_key(ret_ty), tuple(assoc_flags))
+
 def type_check_call_helper(loc, new_rator, args, env, recfun, subterms, ret_ty, call):
   if get_verbose():
       print('tc_call_helper(' + str(call) + ') rator type: ' + str(new_rator.typeof))
   funty = new_rator.typeof
   match funty:
     case OverloadType(loc2, overloads):
-      num_matches = 0
+      # Skip the overloads with the wrong number of parameters.
+      candidates = []
+      assoc_flags = []
       for (x, funty) in overloads:
+          match funty:
+            case FunctionType(loc3, typarams, param_types, return_type):
+              is_assoc = is_associative(loc, x, return_type, env)
+              assoc_flags.append(is_assoc)
+              if (is_assoc and len(args) >= len(param_types)) \
+                 or len(args) == len(param_types):
+                candidates.append((x, funty))
+            case _:
+              assoc_flags.append(None)
+      key = overload_cache_key(overloads, args, env, ret_ty, assoc_flags)
+      if key in overload_cache:
+          (x, funty) = overload_cache[key]
+          count('overload trials', base_name(x))
+          try:
+            return type_check_call_funty(loc, Var(funty.location, funty, x, []), args, env, recfun,
+                                         subterms, ret_ty, call,
+                                         funty.type_params, funty.param_types,
+                                         funty.return_type)
+          except Exception as e:
+            pass
+      num_matches = 0
+      arg_memo = {}
+      for (x, funty) in candidates:
           match funty:
             case FunctionType(loc2, typarams, param_types, return_type):
+              count('overload trials', base_name(x))
               try:
                 new_call = type_check_call_funty(loc, Var(loc2, funty, x, []), args, env, recfun,
                                                  subterms, ret_ty, call,
-                                                 typarams, param_types, return_type)
+                                                 typarams, param_types, return_type,
+                                                 arg_memo)
                 num_matches += 1
+                selected = (x, funty)
               except Exception as e:
                 pass
+      if num_matches == 1 and key is not None:
+          overload_cache[key] = selected
       if num_matches == 0:
           arg_types = [type_synth_term(arg, env, None, []).typeof for arg in args]
           error(loc, 'could not find a match for function call:\n\t' \
@@ -2496,13 +2624,15 @@ def process_declaration_visibility(decl : Declaration, env: Env, module_chain, d
 
           ast2 = []
           for s in ast:
-            new_s, env = process_declaration(s, env, module_chain, needs_checking)
+            with profile_phase(name, 'process_declaration', stmt_label(s)):
+              new_s, env = process_declaration(s, env, module_chain, needs_checking)
             ast2.append(new_s)
 
           ast3 = []
           already_done_imports = set()
           for s in ast2:
-            new_s = type_check_stmt(s, env, already_done_imports)
+            with profile_phase(name, 'type_check_stmt', stmt_label(s)):
+              new_s = type_check_stmt(s, env, already_done_imports)
             ast3.append(new_s)
 
           if needs_checking[0]:
@@ -2514,11 +2644,13 @@ def process_declaration_visibility(decl : Declaration, env: Env, module_chain, d
                   print('> checking ' + name)
               
           for s in ast3:
-            env = collect_env(s, env)
+            with profile_phase(name, 'collect_env', stmt_label(s)):
+              env = collect_env(s, env)
 
             # TODO: only check if the pf file is newer than the thm file
             if name not in checked_modules and needs_checking[0]:
-              check_proofs(s, env)
+              with profile_phase(name, 'check_proofs', stmt_label(s)):
+                check_proofs(s, env)
             
           if name not in checked_modules:
             checked_modules.add(name)  
@@ -3007,22 +3139,6 @@ def add_vars(vars, call):
 
 def find_rec_calls(name, term, env):
   match term:
-    case TermInst(loc2, tyof, subject, tyargs, inferred):
-      return find_rec_calls(name, subject, env)
-    case Var(loc2, tyof, name, resolved_names):
-      return []
-    case Bool(loc2, tyof, val):
-      return []
-    case And(loc2, tyof, args):
-      return sum([find_rec_calls(name, arg, env) for arg in args], [])
-    case Or(loc2, tyof, args):
-      return sum([find_rec_calls(name, arg, env) for arg in args], [])
-    case IfThen(loc2, tyof, prem, conc):
-      return find_rec_calls(name, prem, env) + find_rec_calls(name, conc, env)
-    case All(loc2, tyof, var, pos, frm2):
-      return find_rec_calls(name, frm2, env)
-    case Some(loc2, tyof, vars, frm2):
-      return find_rec_calls(name, frm2, env)
     case Call(loc2, tyof, rator, args):
       calls = find_rec_calls(name, rator, env) + \
           sum([find_rec_calls(name, arg, env) for arg in args], [])
@@ -3046,12 +3162,6 @@ def find_rec_calls(name, term, env):
             new_c_body_calls = [add_vars(params_types, call) for call in new_c_body_calls]
         calls += new_c_body_calls
       return calls
-  
-    case RecFun(loc, name, typarams, params, returns, cases):
-      return []
-    case GenRecFun(loc, name, typarams, params, returns, measure, measure_ty,
-                   body, terminates):
-      return []
     case Conditional(loc2, tyof, cond, thn, els):
       thn_calls = find_rec_calls(name, thn, env)
       els_calls = find_rec_calls(name, els, env)
@@ -3059,24 +3169,11 @@ def find_rec_calls(name, term, env):
       not_cond = IfThen(loc2, None, cond, Bool(loc2, None, False))
       new_els_calls = [add_condition(not_cond, call) for call in els_calls]
       return find_rec_calls(name, cond, env) + new_thn_calls + new_els_calls
-    case Lambda(loc2, tyof, vars, body):
-      return find_rec_calls(name, body, env)
-    case Generic(loc2, tyof, typarams, body):
-      return find_rec_calls(name, body, env)
-    case TAnnote(loc2, tyof, subject, typ):
-      return find_rec_calls(name, subject, env)
-    case ArrayGet(loc2, tyof, arr, ind):
-      return find_rec_calls(name, arr, env) \
-          + find_rec_calls(name, ind, env)
-    case TLet(loc2, tyof, var, rhs, body):
-      return find_rec_calls(name, rhs, env) \
-          + find_rec_calls(name, body, env)
-    case Hole(loc2, tyof):
-      return []
-    case Omitted(loc2, tyof):
-      return []
+    case _ if type(term).child_slots is None:
+      error(term.location, 'in find_rec_calls, unhandled ' + str(term))
     case _:
-      error(loc, 'in find_rec_calls, unhandled ' + str(term))
+      # The calls in the children, where no condition is added.
+      return sum([find_rec_calls(name, child, env) for child in children(term)], [])
     
 
 def check_proofs(stmt, env: Env):
@@ -3205,6 +3302,20 @@ def check_proofs(stmt, env: Env):
     case _:
       error(stmt.location, "check_proofs: unrecognized statement:\n" + str(stmt))
       
+def stmt_label(stmt):
+  if hasattr(stmt, 'name') and isinstance(stmt.name, str):
+    return base_name(stmt.name)
+  return None
+
+def charge_proof_costs():
+  """Wrap check_proof and check_proof_of so that --heatmap and
+  --trace-json get the cost of each proof step. The calls between them
+  go through the module's globals, so they are wrapped too."""
+  global check_proof, check_proof_of
+  if not hasattr(check_proof, '__wrapped__'):
+    check_proof = proof_cost(check_proof)
+    check_proof_of = proof_cost(check_proof_of)
+
 def check_deduce(ast, module_name, modified, tracing_functions):
   env = Env()
   env = env.declare_module(module_name)
@@ -3214,7 +3325,8 @@ def check_deduce(ast, module_name, modified, tracing_functions):
   if get_verbose():
       print('--------- Processing Declarations ------------------------')
   for s in ast:
-    new_s, env = process_declaration(s, env, [module_name], needs_checking)
+    with profile_phase(module_name, 'process_declaration', stmt_label(s)):
+      new_s, env = process_declaration(s, env, [module_name], needs_checking)
     ast2.append(new_s)
   if get_verbose():
     for s in ast2:
@@ -3234,7 +3346,8 @@ def check_deduce(ast, module_name, modified, tracing_functions):
 
   already_done_imports = set()
   for s in ast2:
-    new_s = type_check_stmt(s, env, already_done_imports)
+    with profile_phase(module_name, 'type_check_stmt', stmt_label(s)):
+      new_s = type_check_stmt(s, env, already_done_imports)
     ast3.append(new_s)
     
   if get_verbose():
@@ -3247,9 +3360,11 @@ def check_deduce(ast, module_name, modified, tracing_functions):
     if get_verbose() and needs_checking[0]:
         print('checking ' + module_name)
     for s in ast3:
-      env = collect_env(s, env)
+      with profile_phase(module_name, 'collect_env', stmt_label(s)):
+        env = collect_env(s, env)
       if needs_checking[0]:
-        check_proofs(s, env)
+        with profile_phase(module_name, 'check_proofs', stmt_label(s)):
+          check_proofs(s, env)
     checked_modules.add(module_name)  
 
 
@@ -2,9 +2,10 @@
 # is to provide better error messages. -Jeremy
 
 from abstract_syntax import *
-from lark import Lark, Token, logger, exceptions, tree
+from lexer import Lexer
 from error import *
-from edit_distance import closest_keyword, edit_distance
+from edit_distance import closest_keyword, suggestion_index
+from profiler import profile_phase
 
 filename = '???'
 
@@ -41,14 +42,16 @@ to_unicode = {'.o.': '∘', '|': '∪', '&': '∩', '.+.': '⨄', '<=': '≤', '
 
 accessiblity_keywords = {'OPAQUE', 'PRIVATE', 'PUBLIC'}
 
-lark_parser = None
+lexer = None
+lexer_file = None
 
 def init_parser():
-  global lark_parser
+  global lexer, lexer_file
   lark_file = get_deduce_directory() + "/Deduce.lark"
-  lark_parser = Lark(open(lark_file, encoding="utf-8").read(),
-                     start='program',
-                     debug=True, propagate_positions=True)
+  if lexer is not None and lexer_file == lark_file:
+    return
+  lexer_file = lark_file
+  lexer = Lexer(lark_file)
 
 # The current_position needs to be a global so that the changes to the
 # current_position don't get discarded when an exception is
@@ -83,13 +86,13 @@ check_closest_kwd = False
 
 def parse(program_text, trace = False, error_expected = False):
   global token_list, current_position, check_closest_kwd
-  lexed = lark_parser.lex(program_text)
   token_list = []
   current_position = 0
-  for token in lexed:
+  with profile_phase(Path(filename).stem, 'lex'):
+    token_list = lexer.lex(program_text, filename)
     if trace:
-      print(repr(token))
-    token_list.append(token)
+      for token in token_list:
+        print(repr(token))
 
   stmts = []
   while not end_of_file():
@@ -798,7 +801,7 @@ def parse_proof_hi():
     result = None
     meta = meta_from_tokens(token, token)
     for (lhs, rhs, reason) in reversed(eqs):
-        num_marks = count_marks(lhs) + count_marks(rhs)
+        num_marks = locate_mark(lhs).num_marks + locate_mark(rhs).num_marks
         if num_marks == 0 and get_default_mark_LHS():
             new_lhs = Mark(meta, None, lhs)
         else:
@@ -1752,11 +1755,10 @@ def parse_statement():
     return Trace(my_meta, Var(var_meta, None, fun, []))
 
   else:
-    for kw in statement_keywords:
-        if edit_distance(token.value, kw) <= 2:
-            raise ParseError(meta_from_tokens(token, token),
-                  'did you mean "' + kw \
-                  + '" instead of "' + token.value + '"?')
+    for kw in suggestion_index(statement_keywords).close_matches(token.value, 2):
+        raise ParseError(meta_from_tokens(token, token),
+              'did you mean "' + kw \
+              + '" instead of "' + token.value + '"?')
       
     if token.value == '/' and current_position + 1 < len(token_list) and next_token().value == '*':
       raise ParseError(meta_from_tokens(token, token),
@@ -1,8 +1,13 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields, is_dataclass
+import difflib
 import os
+import re
 from signal import signal, SIGINT
 import sys
+import tempfile
 from threading import Thread
+from time import perf_counter
+import traceback
 
 
 parsers = ['--recursive-descent', '--lalr']
@@ -153,6 +158,246 @@ def test_deduce_errors(deduce_call, path):
 
         join_error_threads(threads, len(threads))
 
+# The in-process runner (--in-process). The checker is imported once,
+# the standard library is parsed and uniquified once per parser, and
+# each test file is checked in a fork that inherits all of that, with
+# its output captured and compared against the golden .err file here.
+
+@dataclass
+class TestCase:
+    kind : str          # 'valid', 'error', 'differential', or 'syntax'
+    path : str
+    parser : str
+    dirs : list[str]
+
+def pf_files(path):
+    if os.path.isfile(path):
+        return [path]
+    return [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.pf')]
+
+def test_cases(test_lib, test_passable, test_errors, test_parse, differential):
+    everything = not (test_lib or test_passable or test_errors or test_parse)
+    cases = []
+    # With --differential, each file that should validate is parsed by
+    # both parsers and checked once, and the imported test modules are
+    # parsed by both but not checked.
+    for parser in (['--recursive-descent'] if differential else parsers):
+        kind = 'differential' if differential else 'valid'
+        if test_lib:
+            cases += [TestCase(kind, p, parser, []) for p in pf_files(lib_dir)]
+        if test_passable or everything:
+            paths = pf_files(pass_dir) + ['./example.pf']
+            if everything:
+                paths = pf_files(lib_dir) + paths
+            cases += [TestCase(kind, p, parser, [test_imports_dir, lib_dir]) for p in paths]
+            if differential:
+                cases += [TestCase('syntax', p, parser, []) for p in pf_files(test_imports_dir)]
+    # Like the subprocess runner, the expected errors are only checked
+    # with the default (recursive descent) parser.
+    if test_errors or everything:
+        cases += [TestCase('error', p, '--recursive-descent', [test_imports_dir, lib_dir])
+                  for p in pf_files(error_dir)]
+    if test_parse or everything:
+        cases += [TestCase('error', p, '--recursive-descent', [lib_dir])
+                  for p in pf_files(parse_dir)]
+    return cases
+
+def shard_cases(cases, shard):
+    """The cases of shard i of n (counting from 1), as given by --shard i/n."""
+    (i, n) = [int(x) for x in shard.split('/')]
+    if not 1 <= i <= n:
+        print('Error: --shard expects i/n with 1 <= i <= n, not', shard)
+        exit(-1)
+    return [c for (k, c) in enumerate(cases) if k % n == i - 1]
+
+def preload_stdlib(parser):
+    """Parse and uniquify every module of the standard library, so that the
+    forked workers find them in the cache of uniquified modules. A module
+    that fails is left out, and the test that imports it reports the error."""
+    import abstract_syntax, flags, rec_desc_parser
+    import parser as lalr_parser
+    modules = abstract_syntax.get_uniquified_modules()
+    modules.clear()
+    flags.set_recursive_descent(parser == '--recursive-descent')
+    flags.init_import_directories()
+    flags.add_import_directory(lib_dir)
+    p = rec_desc_parser if parser == '--recursive-descent' else lalr_parser
+    p.set_deduce_directory('.')
+    p.init_parser()
+    for path in pf_files(lib_dir):
+        name = os.path.basename(path)[:-3]
+        if name in modules:
+            continue
+        before = dict(modules)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            p.set_filename(path)
+            ast = p.parse(text, trace=False, error_expected=False)
+            abstract_syntax.uniquify_deduce(ast)
+            modules[name] = ast
+        except Exception:
+            modules.clear()
+            modules.update(before)
+        abstract_syntax.set_current_module('none')
+
+# The fields that the parsers may fill in differently without a
+# difference in meaning. The recursive-descent parser leaves the
+# visibility of a declaration without one as 'default', which the lalr
+# parser resolves to 'private' for an import and 'public' otherwise.
+def resolved_visibility(node):
+    if node.visibility != 'default':
+        return node.visibility
+    return 'private' if type(node).__name__ == 'Import' else 'public'
+
+def syntax_difference(a, b, path='ast'):
+    """Where the two abstract syntax trees first differ, ignoring source
+    locations, or None if they are the same."""
+    if isinstance(a, str) and isinstance(b, str):
+        return None if str(a) == str(b) else f'{path}: {str(a)!r} vs {str(b)!r}'
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        if len(a) != len(b):
+            return f'{path}: {len(a)} vs {len(b)} elements'
+        for (i, (x, y)) in enumerate(zip(a, b)):
+            d = syntax_difference(x, y, f'{path}[{i}]')
+            if d is not None:
+                return d
+        return None
+    if type(a) != type(b):
+        return f'{path}: {type(a).__name__} vs {type(b).__name__}'
+    if is_dataclass(a):
+        for f in fields(a):
+            if f.name == 'location':
+                continue
+            if f.name == 'visibility':
+                d = syntax_difference(resolved_visibility(a), resolved_visibility(b),
+                                      path + '.visibility')
+            else:
+                d = syntax_difference(getattr(a, f.name), getattr(b, f.name),
+                                      path + '.' + f.name)
+            if d is not None:
+                return d
+        return None
+    return None if a == b else f'{path}: {a!r} vs {b!r}'
+
+def compare_parsers(path):
+    """Parse the file with both parsers and exit with 1 if they disagree."""
+    import rec_desc_parser
+    import parser as lalr_parser
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    asts = []
+    for p in [rec_desc_parser, lalr_parser]:
+        p.set_deduce_directory('.')
+        p.set_filename(path)
+        p.init_parser()
+        asts.append(p.parse(text, trace=False, error_expected=False))
+    difference = syntax_difference(asts[0], asts[1])
+    if difference is not None:
+        print('the parsers disagree on', path)
+        print('  recursive descent vs lalr at', difference)
+        exit(1)
+
+def check_case(case):
+    """Check one test file in this process, as ./deduce.py would."""
+    import deduce, flags
+    if case.kind in ['differential', 'syntax']:
+        compare_parsers(case.path)
+        if case.kind == 'syntax':
+            return
+    flags.init_import_directories()
+    for d in case.dirs + [lib_dir + '/']:
+        flags.add_import_directory(d)
+    flags.set_recursive_descent(case.parser == '--recursive-descent')
+    flags.set_quiet_mode(case.kind == 'error')
+    deduce.suppress_theorems = True
+    deduce.deduce_file(case.path, False, [])
+
+def run_case(case, out):
+    """In a forked child: check the case with stdout sent to `out`, and exit."""
+    os.dup2(out.fileno(), 1)
+    code = 0
+    try:
+        check_case(case)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc(file=sys.stdout)
+        code = 1
+    sys.stdout.flush()
+    os._exit(code)
+
+def same_ignoring_space(expected, actual):
+    """Like diff --ignore-space-change: runs of white space are equal to
+    each other and white space at the end of a line is ignored."""
+    normalize = lambda text: [re.sub(r'\s+', ' ', line.rstrip()) for line in text.splitlines()]
+    return normalize(expected) == normalize(actual)
+
+def judge(case, code, output):
+    """Whether the case passed, and what to show if it did not."""
+    if case.kind != 'error':
+        return (code == 0, output)
+    err_file = case.path + '.err'
+    if not os.path.isfile(err_file):
+        return (False, "Couldn't find an expected error for " + case.path + '\n'
+                + 'Did you mean to generate it? If so, use --generate-error <filename>\n')
+    with open(err_file, 'r', encoding='utf-8') as f:
+        expected = f.read()
+    if same_ignoring_space(expected, output):
+        return (True, '')
+    return (False, ''.join(difflib.unified_diff(expected.splitlines(True), output.splitlines(True),
+                                                err_file, 'actual')))
+
+def run_cases(cases, jobs):
+    """Run the cases in at most `jobs` forked workers and return the failures."""
+    failures = []
+    queue = list(cases)
+    running = {}
+    while len(queue) > 0 or len(running) > 0:
+        while len(queue) > 0 and len(running) < jobs:
+            case = queue.pop(0)
+            out = tempfile.TemporaryFile()
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                run_case(case, out)
+            running[pid] = (case, out)
+        (pid, status) = os.wait()
+        (case, out) = running.pop(pid)
+        out.seek(0)
+        output = out.read().decode('utf-8', errors='replace')
+        out.close()
+        (passed, message) = judge(case, os.waitstatus_to_exitcode(status), output)
+        if passed:
+            print('passed:', case.path, case.parser)
+        else:
+            print('FAILED:', case.path, case.parser)
+            print(message)
+            failures.append(case)
+    return failures
+
+def test_in_process(cases, jobs):
+    start = perf_counter()
+    sys.argv[0] = './deduce.py'
+    sys.setrecursionlimit(10000)
+    failures = []
+    for parser in parsers:
+        group = [c for c in cases if c.parser == parser]
+        if len(group) > 0:
+            preload_stdlib(parser)
+            if any(c.kind in ['differential', 'syntax'] for c in group):
+                # compare_parsers also needs the lalr parser, which is
+                # slow to build, so build it once before forking.
+                import parser as lalr_parser
+                lalr_parser.set_deduce_directory('.')
+                lalr_parser.init_parser()
+            failures += run_cases(group, jobs)
+    print(f'\n{len(cases) - len(failures)} passed, {len(failures)} failed'
+          f' in {perf_counter() - start:.1f} seconds')
+    for case in failures:
+        print('  failed:', case.path, case.parser)
+    exit(1 if len(failures) > 0 else 0)
+
 if __name__ == "__main__":
     signal(SIGINT, handle_sigint)
     # Check command line arguments
@@ -168,6 +413,11 @@ if __name__ == "__main__":
     test_parse = False
     gen_parse = False
 
+    in_process = False
+    differential = False
+    shard = None
+    jobs = os.cpu_count() or 1
+
     already_processed_next = False
     generate_some_errors = False
     for i in range(1, len(sys.argv)):
@@ -197,12 +447,32 @@ if __name__ == "__main__":
             gen_parse = True
         elif argument == '--site':
             test_site = True
+        elif argument == '--in-process':
+            in_process = True
+        elif argument == '--differential':
+            in_process = True
+            differential = True
+        elif argument == '--shard':
+            shard = sys.argv[i + 1]
+            already_processed_next = True
+        elif argument == '--jobs':
+            jobs = int(sys.argv[i + 1])
+            already_processed_next = True
         else:
             extra_arguments.append(argument)
 
     if generate_errors + generate_some_errors + test_lib + test_passable + test_errors + test_site > 1:
         print("Error: you specified too many flags, some are mutually exclusive")
         exit(-1)
+
+    if in_process:
+        if generate_errors or generate_some_errors or gen_parse or test_site or len(extra_arguments) > 0:
+            print("Error: --in-process only runs the tests, with no other deduce arguments")
+            exit(-1)
+        cases = test_cases(test_lib, test_passable, test_errors, test_parse, differential)
+        if shard is not None:
+            cases = shard_cases(cases, shard)
+        test_in_process(cases, jobs)
             
     python_path = ""
     for i in range(14, 10, -1):